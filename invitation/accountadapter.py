@@ -1,11 +1,12 @@
 from allauth.account.adapter import DefaultAccountAdapter
 from allauth.socialaccount.adapter import DefaultSocialAccountAdapter
 from allauth.exceptions import ImmediateHttpResponse
-from invitation.models import InvitationKey
+from invitation import tickets
+from invitation.cache import group_cache
+from invitation.models import InvitationKey, add_user_to_groups
 from allauth.account.signals import user_signed_up
 
 from django.conf import settings
-from django.contrib.auth.models import Group
 from django.dispatch import receiver
 from django.shortcuts import render
 
@@ -13,6 +14,30 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def get_ticket_error(ticket, check_key=False):
+    """
+    Return the context for the wrong invitation key template if ``ticket``
+    can't be used to sign up, or None if it can.
+
+    The ticket alone is checked without querying the database.  With
+    ``check_key``, when the signup is submitted, the key must still be
+    usable too.
+    """
+    context = ticket.get_context()
+    if not ticket.is_valid():
+        return context
+    if check_key and not InvitationKey.objects.is_key_valid(ticket.key):
+        key = InvitationKey.objects.get_key(ticket.key)
+        if key is None:
+            context['invalid_key'] = True
+        elif key.key_expired():
+            context['expired_key'] = True
+        else:
+            context['no_uses_left_key'] = True
+        return context
+    return None
+
+
 class InvitationAccountAdapter(DefaultAccountAdapter):
     """
     Checks whether or not the site is open for signups.
@@ -23,17 +48,17 @@ class InvitationAccountAdapter(DefaultAccountAdapter):
         #print ('is open for sign up session keys', request.session.keys())
         if getattr(settings, 'ALLOW_NEW_REGISTRATIONS', False):
             if getattr(settings, 'INVITE_MODE', False):
-                invitation_key = request.session.get('invitation_key', False)
-                if invitation_key:
-                    if InvitationKey.objects.is_key_valid(invitation_key):
-                        invitation_recipient =\
-                            request.session.get('invitation_recipient', False)
-                        self.stash_verified_email(request,
-                                                  invitation_recipient[0])
+                ticket = tickets.get_ticket(request)
+                if ticket is not None:
+                    # the key is only checked when the signup is submitted
+                    extra_context = get_ticket_error(
+                        ticket, check_key=request.method == 'POST')
+                    if extra_context is None:
+                        if ticket.recipient:
+                            self.stash_verified_email(request,
+                                                      ticket.recipient)
                         return True
                     else:
-                        extra_context =\
-                            request.session.get('invitation_context', {})
                         template_name = 'invitation/wrong_invitation_key.html'
                         raise ImmediateHttpResponse(render(request,
                                                            template_name,
@@ -53,18 +78,16 @@ class InvitationSocialAccountAdapter(DefaultSocialAccountAdapter):
         #print ('is open for sign up session keys', request.session.keys())
         if getattr(settings, 'ALLOW_NEW_REGISTRATIONS', False):
             if getattr(settings, 'INVITE_MODE', False):
-                invitation_key = request.session.get('invitation_key', False)
-                if invitation_key:
-                    if InvitationKey.objects.is_key_valid(invitation_key):
+                ticket = tickets.get_ticket(request)
+                if ticket is not None:
+                    # social signups can create the user straight from the
+                    # provider callback, so the key is always checked
+                    extra_context = get_ticket_error(ticket, check_key=True)
+                    if extra_context is None:
                         #TODO: get the social account email somehow
-                        #invitation_recipient =\
-                        #    request.session.get('invitation_recipient', False)
-                        #self.stash_verified_email(request,
-                        #                          invitation_recipient[0])
+                        #self.stash_verified_email(request, ticket.recipient)
                         return True
                     else:
-                        extra_context =\
-                            request.session.get('invitation_context', {})
                         template_name = 'invitation/wrong_invitation_key.html'
                         raise ImmediateHttpResponse(render(request,
                                                            template_name,
@@ -81,17 +104,27 @@ def complete_signup(sender, **kwargs):
     #sociallogin = request.session.get('socialaccount_sociallogin', None)
 
     # Handle user permissions
+    group_names = []
     if hasattr(settings, 'DEFAULT_USER_GROUP'):
-        user.groups.add(Group.objects.get(name=settings.DEFAULT_USER_GROUP))
-        user.save()
+        group_names.append(settings.DEFAULT_USER_GROUP)
 
     # Handle invitation if required
-    if 'invitation_key' in request.session.keys():
-        invitation_key = request.session.get('invitation_key', False)
-        key = InvitationKey.objects.get_key(invitation_key)
-        if key is not None:
-            key.group_user(user)
-            key.mark_used(user)
-        del request.session['invitation_key']
-        del request.session['invitation_recipient']
-        del request.session['invitation_context']
+    # the key was checked when the signup was submitted, the use is only
+    # taken now
+    ticket = tickets.get_ticket(request)
+    if ticket is not None:
+        tickets.clear_ticket(request)
+        key = InvitationKey.objects.get_key(ticket.key)
+        if key is not None and key.mark_used(user):
+            key.group_user(user, group_names)
+            return
+        if getattr(settings, 'INVITE_MODE', False):
+            # another signup took the last use after the key was checked,
+            # disable the account rather than let it in uninvited
+            logger.warning("Invitation key %s couldn't be used by %s",
+                           ticket.key, user)
+            user.is_active = False
+            user.save(update_fields=['is_active'])
+            return
+    if group_names:
+        add_user_to_groups(user, group_cache.get_ids(group_names))
@@ -1,19 +1,60 @@
 from django.contrib import admin
-from invitation.models import InvitationKey, InvitationUser
+from django.utils.timezone import now
+from django.utils.translation import ugettext_lazy as _
+from invitation.models import (InvitationDelivery, InvitationKey,
+                               InvitationUser)
+
+
+class UsableListFilter(admin.SimpleListFilter):
+    title = _('usable')
+    parameter_name = 'usable'
+
+    def lookups(self, request, model_admin):
+        return (('1', _('Yes')), ('0', _('No')))
+
+    def queryset(self, request, queryset):
+        if self.value() == '1':
+            return queryset.usable()
+        if self.value() == '0':
+            return queryset.exclude(pk__in=queryset.usable().values('pk'))
+        return queryset
 
 
 class InvitationKeyAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'from_user', 'recipient_email', 'date_invited',
                     'uses_left', 'key_expired', 'expiry_date',
                     'recipient_first_name', 'recipient_last_name',
-                    'recipient_other', 'groups')
-    filter_horizontal = ('registrant',)
+                    'recipient_other', 'group_names')
+    list_filter = (UsableListFilter,)
+    filter_horizontal = ('registrant', 'groups')
     readonly_fields = ('registrant',)
 
+    def get_queryset(self, request):
+        queryset = super(InvitationKeyAdmin, self).get_queryset(request)
+        return queryset.prefetch_related('groups')
+
+    def group_names(self, obj):
+        return ', '.join(group.name for group in obj.groups.all())
+    group_names.short_description = _('groups')
+
 
 class InvitationUserAdmin(admin.ModelAdmin):
     list_display = ('inviter', 'invites_remaining', 'invites_allocated',
-                    'invites_sent', 'invites_accepted')
+                    'invites_sent_count', 'invites_accepted')
+
+
+class InvitationDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('invitation', 'status', 'attempts', 'next_attempt',
+                    'date_created')
+    list_filter = ('status',)
+    raw_id_fields = ('invitation',)
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        queryset.update(status=InvitationDelivery.PENDING, attempts=0,
+                        next_attempt=now())
+    retry.short_description = _('Retry selected deliveries')
 
 admin.site.register(InvitationKey, InvitationKeyAdmin)
 admin.site.register(InvitationUser, InvitationUserAdmin)
+admin.site.register(InvitationDelivery, InvitationDeliveryAdmin)
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class InvitationConfig(AppConfig):
+    name = 'invitation'
+
+    def ready(self):
+        from invitation import utils
+        utils.check_configuration()
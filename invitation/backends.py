@@ -1,19 +1,42 @@
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
+from django.core.signals import setting_changed
+from django.template.loader import get_template
 from django.utils.html import strip_tags
 from django.utils.safestring import mark_safe
 
 
-from invitation import (utils, models)
+from invitation import (utils, models, tickets)
+from invitation.mail import get_connection_pool
 from invitation.models import InvitationKey
+from invitation.signals import invite_invited
 
 import logging
 logger = logging.getLogger(__name__)
 
-reg_backend_str = getattr(settings, 'INVITE_REGISTRATION_BACKEND',
-                          'allauth.account.auth_backends.AuthenticationBackend')
-DefaultBackend = utils.str_to_class(reg_backend_str)
+_templates = {}
+
+
+def get_cached_template(template_name):
+    """
+    Return the compiled ``template_name``, loading it only once per process.
+    Templates are loaded every time in DEBUG mode so that edits show up
+    without restarting.
+    """
+    if settings.DEBUG:
+        return get_template(template_name)
+    template = _templates.get(template_name)
+    if template is None:
+        template = _templates[template_name] = get_template(template_name)
+    return template
+
+
+def clear_template_cache(**kwargs):
+    if kwargs.get('setting') in (None, 'TEMPLATES', 'DEBUG'):
+        _templates.clear()
+
+
+setting_changed.connect(clear_template_cache)
 
 
 class BaseRegistrationBackend():
@@ -97,17 +120,41 @@ class InvitationMixin():
         """
         invitation_key = request.REQUEST.get('invitation_key')
         key = InvitationKey.objects.get_key(invitation_key)
-        if key:
-            key.mark_used(user)
-
-            # delete it from the session too
-            del request.session['invitation_key']
+        # delete it from the session too
+        tickets.clear_ticket(request)
+        if (key is None or not key.mark_used(user)) and \
+                getattr(settings, 'INVITE_MODE', False):
+            # another registration took the last use after the key was
+            # checked, disable the account rather than let it in uninvited
+            logger.warning("Invitation key %s couldn't be used by %s",
+                           invitation_key, user)
+            user.is_active = False
+            user.save(update_fields=['is_active'])
+            return ('registration_disallowed', (), {})
 
         return ('registration_complete', (), {})
 
 
-class InvitationBackend(InvitationMixin, DefaultBackend):
-    pass
+def __getattr__(name):
+    """
+    Build ``DefaultBackend`` and ``InvitationBackend`` on first use, so that
+    importing this module doesn't import the registration backend (allauth
+    by default).
+    """
+    if name not in ('DefaultBackend', 'InvitationBackend'):
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+    reg_backend_str = getattr(
+        settings, 'INVITE_REGISTRATION_BACKEND',
+        'allauth.account.auth_backends.AuthenticationBackend')
+    DefaultBackend = utils.str_to_class(reg_backend_str)
+
+    class InvitationBackend(InvitationMixin, DefaultBackend):
+        pass
+
+    globals().update(DefaultBackend=DefaultBackend,
+                     InvitationBackend=InvitationBackend)
+    return globals()[name]
 
 
 class BaseDeliveryBackend():
@@ -125,9 +172,13 @@ class BaseDeliveryBackend():
             return {models.KEY_GROUPS: self.data.get('groups')}
         return {}
 
-    def create_invitation(self, user):
+    def create_invitation(self, user, reserve=False):
         recipient_dict = self.get_recipient_dict()
-        return InvitationKey.objects.create_invitation(user, recipient_dict)
+        return InvitationKey.objects.create_invitation(user, recipient_dict,
+                                                       reserve=reserve)
+
+    def create_invitations(self, user, recipient_dicts):
+        return InvitationKey.objects.create_invitations(user, recipient_dicts)
 
     def send_invitation(self, context):
         c = {}
@@ -135,6 +186,31 @@ class BaseDeliveryBackend():
         c.update(self.get_extra_context())
         self._send_invitation(c)
 
+    def send_invitations(self, invitations, request=None):
+        """
+        Send a batch of invitations without stopping at the first failure, or
+        queue them if ``settings.INVITATION_DELIVERY_QUEUE`` is set.  The
+        links point to the site and scheme of ``request`` when given.
+        Returns a list of ``(invitation, exception)`` for the invitations
+        that couldn't be sent.
+        """
+        queue = utils.get_delivery_queue()
+        if queue:
+            queue.enqueue(invitations, self, request)
+            return []
+        return self._send_invitations(invitations, request)
+
+    def _send_invitations(self, invitations, request=None):
+        shared_context = models.get_shared_context(request)
+        failed = []
+        for invitation in invitations:
+            try:
+                invitation.deliver(self, shared_context)
+            except Exception as e:
+                logger.exception("Sending invitation %s failed", invitation.pk)
+                failed.append((invitation, e))
+        return failed
+
     def _send_invitation(self, context):
         raise NotImplementedError("Create a subclass and implement method")
 
@@ -142,7 +218,6 @@ class BaseDeliveryBackend():
         raise NotImplementedError("Create a subclass and implement method")
 
 
-# TODO: figure out option for doing this as async(celery) task
 class EmailDeliveryBackend(BaseDeliveryBackend):
     subject_template = 'invitation/invitation_email_subject.txt'
     html_template = 'invitation/invitation_email.html'
@@ -154,17 +229,27 @@ class EmailDeliveryBackend(BaseDeliveryBackend):
         return d
 
     def get_extra_context(self):
-        return {'sender_note': self.data.get("sender_note", "")}
-
-    def _send_invitation(self, context):
-        subject = render_to_string(self.subject_template, context)
+        extra_context = {'sender_note': self.data.get("sender_note", "")}
+        if self.data.get('from_email'):
+            extra_context['from_email'] = self.data['from_email']
+        return extra_context
+
+    def get_templates(self):
+        return (get_cached_template(self.subject_template),
+                get_cached_template(self.html_template),
+                get_cached_template(self.text_template))
+
+    def build_message(self, context, templates=None):
+        subject_template, html_template, text_template = \
+            templates or self.get_templates()
+        subject = subject_template.render(context)
         # Email subject *must not* contain newlines
         subject = ''.join(subject.splitlines())
 
-        message_html = render_to_string(self.html_template, context)
+        message_html = html_template.render(context)
         note = mark_safe(strip_tags(context.get('sender_note')))
         context.update({'sender_note': note})
-        message = render_to_string(self.text_template, context)
+        message = text_template.render(context)
         default_from_email = getattr(settings, 'DEFAULT_FROM_EMAIL',
                                      'set_DEFAULT_FROM_EMAIL@thissite.com')
         msg = EmailMultiAlternatives(subject, message,
@@ -172,7 +257,34 @@ class EmailDeliveryBackend(BaseDeliveryBackend):
                                                  default_from_email),
                                      [context.get('recipient_email')])
         msg.attach_alternative(message_html, "text/html")
-        msg.send()
+        return msg
+
+    def _send_invitation(self, context):
+        get_connection_pool().send_messages([self.build_message(context)])
+
+    def _send_invitations(self, invitations, request=None):
+        """
+        Load the templates and build the shared context once for the whole
+        batch and send every message over the pooled connections.
+        """
+        templates = self.get_templates()
+        shared_context = models.get_shared_context(request)
+        extra_context = self.get_extra_context()
+        pool = get_connection_pool()
+        failed = []
+        for invitation in invitations:
+            try:
+                context = invitation.get_context(extra_context,
+                                                 shared_context)
+                pool.send_messages([self.build_message(context, templates)])
+            except Exception as e:
+                logger.exception("Sending invitation %s failed",
+                                 invitation.pk)
+                failed.append((invitation, e))
+            else:
+                invite_invited.send(sender=InvitationKey,
+                                    invite_key=invitation)
+        return failed
 
 
 class NamedEmailDeliveryBackend(EmailDeliveryBackend):
@@ -0,0 +1,193 @@
+from hashlib import sha1 as sha_constructor
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.timezone import now
+
+
+class BaseKeyCache():
+    """
+    Base class for invitation key validation caches.  To create a custom
+    cache, inherit from this class and implement the methods.
+
+    ``get`` returns a ``(hit, value)`` tuple where ``value`` is either a
+    usable ``InvitationKey`` or ``None`` for keys known to be invalid.
+    """
+
+    def get(self, invitation_key):
+        raise NotImplementedError("Create a subclass and implement method")
+
+    def set_valid(self, invitation_key):
+        raise NotImplementedError("Create a subclass and implement method")
+
+    def set_invalid(self, invitation_key):
+        raise NotImplementedError("Create a subclass and implement method")
+
+    def invalidate(self, invitation_key):
+        raise NotImplementedError("Create a subclass and implement method")
+
+
+class DummyKeyCache(BaseKeyCache):
+    """
+    Never caches anything, every validation goes to the database.
+    """
+
+    def get(self, invitation_key):
+        return False, None
+
+    def set_valid(self, invitation_key):
+        pass
+
+    def set_invalid(self, invitation_key):
+        pass
+
+    def invalidate(self, invitation_key):
+        pass
+
+
+class KeyValidationCache(BaseKeyCache):
+    """
+    Caches the result of ``InvitationKeyManager.is_key_valid`` in one of the
+    caches configured in ``settings.CACHES``.
+
+    Valid keys are cached for ``INVITATION_KEY_CACHE_TIMEOUT`` seconds but
+    never beyond their expiry date.  Unknown or unusable keys are cached for
+    the (shorter) ``INVITATION_KEY_CACHE_NEGATIVE_TIMEOUT`` so that replayed
+    bogus keys don't reach the database.
+    """
+    prefix = 'invitation:key:'
+    invalid = 'invalid'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'INVITATION_KEY_CACHE_ALIAS',
+                              'default')]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'INVITATION_KEY_CACHE_TIMEOUT', 300)
+
+    @property
+    def negative_timeout(self):
+        return getattr(settings, 'INVITATION_KEY_CACHE_NEGATIVE_TIMEOUT', 30)
+
+    def make_key(self, invitation_key):
+        # hash the key so that arbitrary user input is a safe cache key
+        digest = sha_constructor(str(invitation_key).encode()).hexdigest()
+        return self.prefix + digest
+
+    def get(self, invitation_key):
+        value = self.cache.get(self.make_key(invitation_key))
+        if value is None:
+            return False, None
+        if value == self.invalid:
+            return True, None
+        return True, value
+
+    def set_valid(self, invitation_key):
+        timeout = self.timeout
+        expiry_date = invitation_key.get_expiry_datetime()
+        if expiry_date is not None:
+            remaining = int((expiry_date - now()).total_seconds())
+            timeout = min(timeout, remaining)
+        if timeout > 0:
+            self.cache.set(self.make_key(invitation_key.key), invitation_key,
+                           timeout)
+
+    def set_invalid(self, invitation_key):
+        self.cache.set(self.make_key(invitation_key), self.invalid,
+                       self.negative_timeout)
+
+    def invalidate(self, invitation_key):
+        self.cache.delete(self.make_key(invitation_key))
+
+
+class RemainingInvitationsCache():
+    """
+    Optional short lived cache of each user's remaining invitations, used by
+    the ``remaining_invitations`` context processor.  Enabled by setting
+    ``INVITATION_REMAINING_CACHE_TIMEOUT`` to a number of seconds.
+
+    Entries are namespaced by a generation number so that bulk changes (like
+    topping off every user) can invalidate all of them at once.
+    """
+    prefix = 'invitation:remaining:'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'INVITATION_KEY_CACHE_ALIAS',
+                              'default')]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'INVITATION_REMAINING_CACHE_TIMEOUT', 0)
+
+    def make_key(self, user_id):
+        generation = self.cache.get(self.prefix + 'generation', 0)
+        return '%s%s:%s' % (self.prefix, generation, user_id)
+
+    def get(self, user_id):
+        if not self.timeout:
+            return None
+        return self.cache.get(self.make_key(user_id))
+
+    def set(self, user_id, remaining):
+        if self.timeout:
+            self.cache.set(self.make_key(user_id), remaining, self.timeout)
+
+    def invalidate(self, user_id=None):
+        """
+        Forget the entry of ``user_id``, or of all users if it's None.
+        """
+        if not self.timeout:
+            return
+        if user_id is not None:
+            self.cache.delete(self.make_key(user_id))
+            return
+        try:
+            self.cache.incr(self.prefix + 'generation')
+        except ValueError:
+            self.cache.set(self.prefix + 'generation', 1, None)
+
+
+remaining_cache = RemainingInvitationsCache()
+
+
+class GroupIdCache():
+    """
+    Map of group names to ids, used when invitations with groups are created
+    and for ``DEFAULT_USER_GROUP`` at signup.  Kept for
+    ``INVITATION_GROUP_CACHE_TIMEOUT`` seconds and dropped whenever a
+    ``Group`` is saved or deleted.
+    """
+    key = 'invitation:groups'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'INVITATION_KEY_CACHE_ALIAS',
+                              'default')]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'INVITATION_GROUP_CACHE_TIMEOUT', 3600)
+
+    def get_map(self):
+        mapping = self.cache.get(self.key)
+        if mapping is None:
+            from django.contrib.auth.models import Group
+            mapping = dict(Group.objects.values_list('name', 'pk'))
+            self.cache.set(self.key, mapping, self.timeout)
+        return mapping
+
+    def get_ids(self, names):
+        """
+        Return the ids of the groups named ``names``, skipping unknown names.
+        """
+        mapping = self.get_map()
+        return [mapping[name] for name in names if name in mapping]
+
+    def invalidate(self, **kwargs):
+        self.cache.delete(self.key)
+
+
+group_cache = GroupIdCache()
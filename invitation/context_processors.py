@@ -1,13 +1,93 @@
+from invitation.cache import remaining_cache
 from invitation.models import InvitationKey
 
 
+def get_remaining_invitations(request):
+    """
+    Return the remaining invitations of ``request.user``, computed at most
+    once per request.
+    """
+    if not hasattr(request, '_cached_remaining_invitations'):
+        remaining_invites = remaining_cache.get(request.user.pk)
+        if remaining_invites is None:
+            objs = InvitationKey.objects
+            remaining_invites = \
+                objs.remaining_invitations_for_user(request.user)
+            remaining_cache.set(request.user.pk, remaining_invites)
+        request._cached_remaining_invitations = remaining_invites
+    return request._cached_remaining_invitations
+
+
+class LazyRemainingInvitations():
+    """
+    The remaining invitations of ``request.user``, computed on first use.
+
+    Unlike ``SimpleLazyObject`` it supports what templates do with numbers:
+    comparisons, ``|add``, ``{% blocktrans count %}`` and so on.
+    """
+
+    def __init__(self, request):
+        self._request = request
+
+    def __int__(self):
+        return get_remaining_invitations(self._request)
+
+    __index__ = __int__
+
+    def __round__(self, ndigits=None):
+        return int(self)
+
+    def __bool__(self):
+        return bool(int(self))
+
+    def __str__(self):
+        return str(int(self))
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, int(self))
+
+    def __hash__(self):
+        return hash(int(self))
+
+    def __eq__(self, other):
+        return int(self) == other
+
+    def __ne__(self, other):
+        return int(self) != other
+
+    def __lt__(self, other):
+        return int(self) < other
+
+    def __le__(self, other):
+        return int(self) <= other
+
+    def __gt__(self, other):
+        return int(self) > other
+
+    def __ge__(self, other):
+        return int(self) >= other
+
+    def __add__(self, other):
+        return int(self) + other
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return int(self) - other
+
+    def __rsub__(self, other):
+        return other - int(self)
+
+
 def remaining_invitations(request):
     """
     determines if the user has any invitations remaining.
+
+    The value is lazy so the database is only queried by templates that
+    actually use it.
     """
-    if request.user.is_authenticated():
-        objs = InvitationKey.objects
-        remaining_invites = objs.remaining_invitations_for_user(request.user)
+    if request.user.is_authenticated:
+        remaining_invites = LazyRemainingInvitations(request)
     else:
         remaining_invites = None
     return {'remaining_invitations': remaining_invites}
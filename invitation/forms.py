@@ -1,7 +1,8 @@
 from django import forms
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
-import re
+
+from invitation import utils
 
 
 class BaseInvitationKeyForm(forms.Form):
@@ -21,8 +22,6 @@ class DefaultInvitationKeyForm(BaseInvitationKeyForm):
     def __init__(self, *args, **kwargs):
         self.remaining_invitations = kwargs.pop('remaining_invitations', None)
         self.user = kwargs.pop('user', None)
-        self.invitation_blacklist = getattr(settings, 'INVITATION_BLACKLIST',
-                                            ())
 
         super(DefaultInvitationKeyForm, self).__init__(*args, **kwargs)
 
@@ -40,13 +39,10 @@ class DefaultInvitationKeyForm(BaseInvitationKeyForm):
                 del cleaned_data['email']
 
         if 'email' in self.cleaned_data:
-            for email_match in self.invitation_blacklist:
-                search = re.search(email_match, self.cleaned_data['email'])
-                if search is not None:
-                    err = _("Thanks, but there's no need to invite us!")
-                    self._errors['email'] = self.error_class([err])
-                    del cleaned_data['email']
-                    break
+            if utils.is_blacklisted(self.cleaned_data['email']):
+                err = _("Thanks, but there's no need to invite us!")
+                self._errors['email'] = self.error_class([err])
+                del cleaned_data['email']
 
         if 'sender_note' in self.cleaned_data:
             note_length = len(cleaned_data['sender_note'])
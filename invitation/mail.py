@@ -0,0 +1,151 @@
+from collections import deque
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool():
+    """
+    A pool of open email connections shared by the delivery backends, so that
+    sending many invitations doesn't connect (and authenticate) once per
+    message.
+
+    At most ``max_connections`` connections are in use at the same time,
+    connections unused for ``idle_timeout`` seconds are closed instead of
+    reused, and a connection the server dropped is reopened once.
+    """
+
+    def __init__(self, backend=None, max_connections=None, idle_timeout=None,
+                 acquire_timeout=None):
+        self.backend = backend
+        if max_connections is None:
+            max_connections = getattr(settings, 'INVITATION_EMAIL_POOL_SIZE',
+                                      4)
+        if idle_timeout is None:
+            idle_timeout = getattr(settings,
+                                   'INVITATION_EMAIL_POOL_IDLE_TIMEOUT', 30)
+        if acquire_timeout is None:
+            acquire_timeout = getattr(
+                settings, 'INVITATION_EMAIL_POOL_ACQUIRE_TIMEOUT', 60)
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._metrics = dict.fromkeys(('opened', 'reused', 'expired',
+                                       'reconnects', 'failures'), 0)
+
+    def get_metrics(self):
+        """
+        Return a snapshot of the pool counters: connections ``opened``,
+        ``reused`` and ``expired`` (closed after being idle too long), plus
+        ``reconnects`` and sending ``failures``.
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['idle'] = len(self._idle)
+        return metrics
+
+    def _count(self, name):
+        with self._lock:
+            self._metrics[name] += 1
+
+    def _open(self):
+        connection = get_connection(self.backend)
+        connection.open()
+        self._count('opened')
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            logger.debug("Closing a pooled connection failed", exc_info=True)
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise RuntimeError("No email connection available after %ss" %
+                               self.acquire_timeout)
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, last_used = self._idle.pop()
+                if time.time() - last_used < self.idle_timeout:
+                    self._count('reused')
+                    return connection
+                self._count('expired')
+                self._close(connection)
+            return self._open()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, connection, broken=False):
+        if broken:
+            self._close(connection)
+        else:
+            with self._lock:
+                self._idle.append((connection, time.time()))
+        self._slots.release()
+
+    def send_messages(self, messages):
+        """
+        Send ``messages`` over a pooled connection and return the number
+        sent.
+        """
+        connection = self.acquire()
+        broken = False
+        try:
+            try:
+                return connection.send_messages(messages)
+            except smtplib.SMTPServerDisconnected:
+                # most likely the server closed the idle connection
+                self._count('reconnects')
+                self._close(connection)
+                connection = self._open()
+                return connection.send_messages(messages)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused):
+            # the connection itself is still usable
+            self._count('failures')
+            raise
+        except Exception:
+            broken = True
+            self._count('failures')
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for connection, last_used in idle:
+            self._close(connection)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """
+    Return the connection pool for the current ``settings.EMAIL_BACKEND``.
+    """
+    with _pools_lock:
+        pool = _pools.get(settings.EMAIL_BACKEND)
+        if pool is None:
+            pool = _pools[settings.EMAIL_BACKEND] = \
+                ConnectionPool(settings.EMAIL_BACKEND)
+        return pool
@@ -1,4 +1,4 @@
-import sys
+import time
 
 from django.core.management.base import BaseCommand
 
@@ -6,15 +6,15 @@ from invitation.models import InvitationUser
 
 
 class Command(BaseCommand):
-    help = "Adds invites to all users with 0 invites remaining."
+    help = "Adds invites to all users that don't have infinite invites."
 
-    def handle(self, *args, **kwargs):
-        if len(args) == 0:
-            sys.exit("You must supply the number of invites as an argument.")
+    def add_arguments(self, parser):
+        parser.add_argument('num_invites', type=int,
+                            help="The number of invites to add")
 
-        try:
-            num_of_invites = int(args[0])
-        except ValueError:
-            sys.exit("The argument for number of invites must be an integer.")
-
-        InvitationUser.add_invites(num_of_invites)
+    def handle(self, *args, **options):
+        start = time.time()
+        updated = InvitationUser.add_invites(options['num_invites'])
+        if options['verbosity'] > 0:
+            self.stdout.write("%d users updated in %.2fs" %
+                              (updated, time.time() - start))
@@ -15,5 +15,25 @@ from invitation.models import InvitationKey
 class Command(BaseCommand):
     help = "Delete expired invitations' keys from the database"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="Number of keys deleted per batch")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Only count the expired keys")
+
     def handle(self, **options):
-        InvitationKey.objects.delete_expired_keys()
+        verbosity = options['verbosity']
+
+        if options['dry_run']:
+            count = InvitationKey.objects.delete_expired_keys(dry_run=True)
+            self.stdout.write("%d expired keys would be deleted" % count)
+            return
+
+        def progress(deleted):
+            if verbosity > 1:
+                self.stdout.write("%d expired keys deleted..." % deleted)
+
+        deleted = InvitationKey.objects.delete_expired_keys(
+            chunk_size=options['chunk_size'], progress=progress)
+        if verbosity > 0:
+            self.stdout.write("%d expired keys deleted" % deleted)
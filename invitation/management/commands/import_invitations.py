@@ -0,0 +1,245 @@
+"""
+A management command which creates invitation keys from a CSV or JSON lines
+file with the columns/fields ``email``, ``first_name``, ``last_name``,
+``groups`` and ``uses``.
+
+The file is streamed and processed ``--chunk-size`` records at a time, so
+memory use doesn't depend on its size.  After every chunk the number of
+records processed is written to a checkpoint file; running the command again
+with the same file resumes after the last completed chunk.  With ``--send``
+the keys of a chunk are kept in the checkpoint until they are sent, and sent
+when resuming if sending was interrupted.
+
+Addresses are compared case insensitively, both within the file and against
+existing users and outstanding keys.
+
+"""
+
+import csv
+import io
+import itertools
+import json
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models.functions import Lower
+
+from invitation import models, utils
+from invitation.models import InvitationKey
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield row
+
+
+def read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+class Command(BaseCommand):
+    help = "Create invitation keys from a CSV or JSON lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The CSV or JSON lines file")
+        parser.add_argument('--from-user', required=True,
+                            help="Username of the user sending the invites")
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            default=None,
+                            help="File format, guessed from the extension "
+                                 "by default")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of records processed per chunk")
+        parser.add_argument('--checkpoint', default=None,
+                            help="Checkpoint file, defaults to the path of "
+                                 "the file with '.checkpoint' appended")
+        parser.add_argument('--send', action='store_true', default=False,
+                            help="Also send the invitations")
+        parser.add_argument('--render-tokens', action='store_true',
+                            default=False,
+                            help="Render the token images up front across "
+                                 "a process pool (INVITATION_USE_TOKEN)")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or \
+            ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        checkpoint = options['checkpoint'] or path + '.checkpoint'
+        self.verbosity = options['verbosity']
+
+        user_model = get_user_model()
+        try:
+            self.from_user = user_model.objects.get(
+                **{user_model.USERNAME_FIELD: options['from_user']})
+        except user_model.DoesNotExist:
+            raise CommandError("Unknown user %s" % options['from_user'])
+
+        self.delivery_backend = None
+        if options['send']:
+            delivery_backend_class = utils.get_delivery_backend_class()
+            self.delivery_backend = delivery_backend_class({})
+
+        self.token_generator = None
+        if options['render_tokens']:
+            self.token_generator = models.get_token_generator()
+            if not hasattr(self.token_generator, 'render_tokens'):
+                raise CommandError("The token generator can't render tokens "
+                                   "in bulk")
+
+        self.max_lengths = dict(
+            (name, InvitationKey._meta.get_field(name).max_length)
+            for name in (models.KEY_EMAIL, models.KEY_FNAME, models.KEY_LNAME))
+        self.counts = dict.fromkeys(('created', 'invalid', 'blacklisted',
+                                     'existing_user', 'outstanding_key',
+                                     'duplicate', 'failed'), 0)
+
+        processed, unsent = self.read_checkpoint(checkpoint, path)
+        if processed and self.verbosity > 0:
+            self.stdout.write("Resuming after %d records" % processed)
+        if unsent and self.delivery_backend is not None:
+            # the last run stopped before sending its last chunk
+            self.send(list(InvitationKey.objects.filter(pk__in=unsent)))
+            self.write_checkpoint(checkpoint, path, processed)
+
+        start = time.time()
+        reader = read_jsonl if file_format == 'jsonl' else read_csv
+        with io.open(path, encoding='utf-8', newline='') as f:
+            records = itertools.islice(reader(f), processed, None)
+            while True:
+                chunk = list(itertools.islice(records, options['chunk_size']))
+                if not chunk:
+                    break
+                invitations = self.import_chunk(chunk)
+                processed += len(chunk)
+                if self.delivery_backend is not None and invitations:
+                    # remember the keys to send until they are, so a crash
+                    # while sending doesn't leave them unsent on resume
+                    self.write_checkpoint(checkpoint, path, processed,
+                                          [i.pk for i in invitations])
+                    self.send(invitations)
+                self.write_checkpoint(checkpoint, path, processed)
+                if self.verbosity > 1:
+                    self.stdout.write("%d records processed..." % processed)
+
+        if self.verbosity > 0:
+            self.stdout.write("%d records processed in %.2fs: %s" % (
+                processed, time.time() - start,
+                ', '.join('%s %d' % item for item in sorted(
+                    self.counts.items()))))
+
+    def read_checkpoint(self, checkpoint, path):
+        """
+        Return the number of records processed and the pks of the keys
+        created but not sent yet.
+        """
+        try:
+            with open(checkpoint) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return 0, []
+        if state.get('path') != os.path.abspath(path):
+            return 0, []
+        return state.get('processed', 0), state.get('unsent', [])
+
+    def write_checkpoint(self, checkpoint, path, processed, unsent=()):
+        tmp = checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'path': os.path.abspath(path), 'processed': processed,
+                       'unsent': list(unsent)}, f)
+        os.rename(tmp, checkpoint)
+
+    def clean_record(self, record):
+        """
+        Return the InvitationKey fields for ``record``, or None if it's
+        invalid.
+        """
+        email = (record.get('email') or '').strip()
+        try:
+            validate_email(email)
+        except ValidationError:
+            return None
+        recipient = {
+            models.KEY_EMAIL: email,
+            models.KEY_FNAME: (record.get('first_name') or '').strip(),
+            models.KEY_LNAME: (record.get('last_name') or '').strip(),
+        }
+        for name, max_length in self.max_lengths.items():
+            if len(recipient[name]) > max_length:
+                return None
+
+        groups = record.get('groups') or []
+        if not isinstance(groups, list):
+            groups = groups.split(',')
+        recipient[models.KEY_GROUPS] = ','.join(
+            group.strip() for group in groups if group.strip())
+
+        try:
+            uses = int(record.get('uses') or 1)
+        except (TypeError, ValueError):
+            return None
+        if uses < 1:
+            return None
+        recipient['uses_left'] = uses
+        return recipient
+
+    def import_chunk(self, chunk):
+        recipients = []
+        seen = set()
+        for record in chunk:
+            recipient = self.clean_record(record)
+            if recipient is None:
+                self.counts['invalid'] += 1
+                continue
+            email = recipient[models.KEY_EMAIL].lower()
+            if email in seen:
+                self.counts['duplicate'] += 1
+                continue
+            seen.add(email)
+            if utils.is_blacklisted(recipient[models.KEY_EMAIL]):
+                self.counts['blacklisted'] += 1
+                continue
+            recipients.append(recipient)
+
+        # addresses are compared case insensitively
+        emails = [recipient[models.KEY_EMAIL].lower()
+                  for recipient in recipients]
+        existing_users = set(
+            get_user_model().objects.annotate(email_lower=Lower('email'))
+            .filter(email_lower__in=emails)
+            .values_list('email_lower', flat=True))
+        outstanding_keys = set(
+            InvitationKey.objects.usable()
+            .annotate(email_lower=Lower('recipient_email'))
+            .filter(email_lower__in=emails)
+            .values_list('email_lower', flat=True))
+
+        new_recipients = []
+        for recipient in recipients:
+            email = recipient[models.KEY_EMAIL].lower()
+            if email in existing_users:
+                self.counts['existing_user'] += 1
+            elif email in outstanding_keys:
+                self.counts['outstanding_key'] += 1
+            else:
+                new_recipients.append(recipient)
+
+        with transaction.atomic():
+            invitations = InvitationKey.objects.create_invitations(
+                self.from_user, new_recipients)
+        self.counts['created'] += len(invitations)
+
+        if self.token_generator is not None and invitations:
+            self.token_generator.render_tokens(invitations)
+        return invitations
+
+    def send(self, invitations):
+        failed = self.delivery_backend.send_invitations(invitations)
+        self.counts['failed'] += len(failed)
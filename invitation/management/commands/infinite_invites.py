@@ -1,3 +1,5 @@
+import time
+
 from django.core.management.base import BaseCommand
 
 from django.contrib.auth import get_user_model
@@ -7,8 +9,25 @@ from invitation.models import InvitationUser
 class Command(BaseCommand):
     help = "Sets invites_allocated to -1 to represent infinite invites."
 
-    def handle(self, *args, **kwargs):
-        for user in get_user_model().objects.all():
-            invite_user, _ = InvitationUser.objects.get_or_create(user=user)
-            invite_user.invites_allocated = -1
-            invite_user.save()
+    def add_arguments(self, parser):
+        parser.add_argument('--staff', action='store_true', default=False,
+                            help="Only update staff users")
+        parser.add_argument('--group', default=None,
+                            help="Only update the members of this group")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of missing InvitationUsers created "
+                                 "per query")
+
+    def handle(self, *args, **options):
+        start = time.time()
+        users = None
+        if options['staff'] or options['group']:
+            users = get_user_model().objects.all()
+            if options['staff']:
+                users = users.filter(is_staff=True)
+            if options['group']:
+                users = users.filter(groups__name=options['group'])
+        updated = InvitationUser.make_infinite(users, options['chunk_size'])
+        if options['verbosity'] > 0:
+            self.stdout.write("%d users updated in %.2fs" %
+                              (updated, time.time() - start))
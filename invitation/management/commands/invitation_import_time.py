@@ -0,0 +1,75 @@
+"""
+A management command which measures how long importing the invitation
+modules takes in a fresh interpreter, to keep an eye on worker and
+management command startup.
+
+For each module a new Python process sets Django up and imports the module;
+the median of ``--repeat`` runs is reported along with the number of modules
+the import pulled in.
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+MODULES = ('invitation.models', 'invitation.backends', 'invitation.views',
+           'invitation.urls')
+
+SCRIPT = """
+import importlib, json, sys, time
+import django
+start = time.perf_counter()
+django.setup()
+setup = time.perf_counter() - start
+before = set(sys.modules)
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({'setup': setup, 'import': time.perf_counter() - start,
+                  'modules': len(set(sys.modules) - before)}))
+"""
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class Command(BaseCommand):
+    help = "Measure the import time of the invitation modules"
+
+    def add_arguments(self, parser):
+        parser.add_argument('modules', nargs='*', default=MODULES,
+                            help="Modules to import, defaults to %s" %
+                                 ', '.join(MODULES))
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="Number of runs per module")
+
+    def measure(self, module):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        try:
+            output = subprocess.check_output(
+                [sys.executable, '-c', SCRIPT, module], env=env,
+                stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise CommandError("Importing %s failed:\n%s" %
+                               (module, e.output.decode('utf-8', 'replace')))
+        return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+            raise CommandError("DJANGO_SETTINGS_MODULE must be set")
+        for module in options['modules']:
+            runs = [self.measure(module)
+                    for _ in range(max(1, options['repeat']))]
+            self.stdout.write(
+                "%-24s import %7.1fms (%d modules), django.setup() %7.1fms" % (
+                    module, median([run['import'] for run in runs]) * 1000,
+                    median([run['modules'] for run in runs]),
+                    median([run['setup'] for run in runs]) * 1000))
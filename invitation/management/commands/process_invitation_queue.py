@@ -0,0 +1,39 @@
+"""
+A management command which delivers the invitations queued when
+``INVITATION_DELIVERY_QUEUE`` is set, suitable for use as a cron job or,
+with ``--loop``, as a long running worker.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invitation import utils
+
+
+class Command(BaseCommand):
+    help = "Deliver queued invitations"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Number of deliveries claimed at once")
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help="Keep polling the queue")
+        parser.add_argument('--sleep', type=float, default=5,
+                            help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        delivery_queue = utils.get_delivery_queue()
+        if delivery_queue is None:
+            raise CommandError("INVITATION_DELIVERY_QUEUE isn't set")
+
+        while True:
+            sent, failed = delivery_queue.process(options['batch_size'])
+            if options['verbosity'] > 0 and (sent or failed):
+                self.stdout.write("%d invitations sent, %d failed" %
+                                  (sent, failed))
+            if not options['loop']:
+                break
+            if not sent and not failed:
+                time.sleep(options['sleep'])
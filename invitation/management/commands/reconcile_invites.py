@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from invitation.models import InvitationUser
+
+
+class Command(BaseCommand):
+    help = "Recomputes the number of invites sent by every user."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of users updated per query")
+
+    def handle(self, *args, **options):
+        updated = InvitationUser.reconcile_invites_sent(options['chunk_size'])
+        if options['verbosity'] > 0:
+            self.stdout.write("%d invitation users reconciled" % updated)
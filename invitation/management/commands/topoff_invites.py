@@ -1,4 +1,4 @@
-import sys
+import time
 
 from django.core.management.base import BaseCommand
 
@@ -8,13 +8,14 @@ from invitation.models import InvitationUser
 class Command(BaseCommand):
     help = "Makes sure all users have a certain number of invites."
 
-    def handle(self, *args, **kwargs):
-        if len(args) == 0:
-            sys.exit("You must supply the number of invites as an argument.")
+    def add_arguments(self, parser):
+        parser.add_argument('num_invites', type=int,
+                            help="The number of invites every user should "
+                                 "have remaining")
 
-        try:
-            num_of_invites = int(args[0])
-        except ValueError:
-            sys.exit("The argument for number of invites must be an integer.")
-
-        InvitationUser.topoff(num_of_invites)
+    def handle(self, *args, **options):
+        start = time.time()
+        updated = InvitationUser.topoff(options['num_invites'])
+        if options['verbosity'] > 0:
+            self.stdout.write("%d users updated in %.2fs" %
+                              (updated, time.time() - start))
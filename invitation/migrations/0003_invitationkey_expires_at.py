@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models, transaction
+import django.utils.timezone
+
+CHUNK_SIZE = 1000
+
+
+def backfill_expires_at(apps, schema_editor):
+    """
+    Store date_invited + duration for every key, one pk range at a time so
+    that large tables aren't updated in a single transaction.
+    """
+    InvitationKey = apps.get_model('invitation', 'InvitationKey')
+    keys = InvitationKey.objects.using(schema_editor.connection.alias)
+    last_pk = keys.aggregate(last_pk=models.Max('pk'))['last_pk'] or 0
+    durations = keys.exclude(duration__lt=0).order_by()\
+        .values_list('duration', flat=True).distinct()
+    whens = []
+    for duration in durations:
+        days = duration or settings.ACCOUNT_INVITATION_DAYS
+        expires_at = models.F('date_invited') + datetime.timedelta(days=days)
+        if duration is None:
+            whens.append(models.When(duration__isnull=True, then=expires_at))
+        else:
+            whens.append(models.When(duration=duration, then=expires_at))
+    if not whens:
+        return
+    expires_at = models.Case(*whens, default=None,
+                             output_field=models.DateTimeField())
+    for start in range(0, last_pk + 1, CHUNK_SIZE):
+        with transaction.atomic(using=schema_editor.connection.alias):
+            keys.filter(pk__gte=start, pk__lt=start + CHUNK_SIZE)\
+                .update(expires_at=expires_at)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('invitation', '0002_auto_20141014_1743'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invitationkey',
+            name='date_invited',
+            field=models.DateTimeField(verbose_name='date invited', default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='invitationkey',
+            name='expires_at',
+            field=models.DateTimeField(verbose_name='expires at', null=True, blank=True, editable=False, db_index=True),
+        ),
+        migrations.RunPython(backfill_expires_at, migrations.RunPython.noop),
+    ]
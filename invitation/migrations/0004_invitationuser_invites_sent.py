@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_invites_sent(apps, schema_editor):
+    InvitationKey = apps.get_model('invitation', 'InvitationKey')
+    InvitationUser = apps.get_model('invitation', 'InvitationUser')
+    sent = InvitationKey.objects\
+        .filter(from_user=models.OuterRef('inviter')).order_by()\
+        .values('from_user').annotate(count=models.Count('pk'))\
+        .values('count')
+    InvitationUser.objects.using(schema_editor.connection.alias)\
+        .update(invites_sent=Coalesce(models.Subquery(sent), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invitation', '0003_invitationkey_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invitationuser',
+            name='invites_sent',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_invites_sent, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invitation', '0004_invitationuser_invites_sent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvitationDelivery',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('backend', models.CharField(max_length=255)),
+                ('data', models.TextField(default='', blank=True)),
+                ('status', models.CharField(default='pending', max_length=10, choices=[('pending', 'pending'), ('sent', 'sent'), ('dead', 'dead')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(default='', blank=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('invitation', models.ForeignKey(to='invitation.InvitationKey', on_delete=django.db.models.deletion.CASCADE, related_name='deliveries')),
+            ],
+            options={
+                'index_together': {('status', 'next_attempt')},
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import secrets
+import string
+
+from django.db import migrations, models
+
+KEY_ALPHABET = string.ascii_letters + string.digits
+
+
+def generate_key(keys):
+    # frozen copy of the key generator when this migration was written, so
+    # later changes to invitation.utils or the settings don't affect it
+    while True:
+        key = ''.join(secrets.choice(KEY_ALPHABET) for i in range(32))
+        if not keys.filter(key=key).exists():
+            return key
+
+
+def replace_duplicate_keys(apps, schema_editor):
+    # the oldest invitation keeps a duplicated key, the others get a new one
+    InvitationKey = apps.get_model('invitation', 'InvitationKey')
+    keys = InvitationKey.objects.using(schema_editor.connection.alias)
+    duplicates = keys.values('key').order_by()\
+        .annotate(count=models.Count('pk')).filter(count__gt=1)\
+        .values_list('key', flat=True)
+    for key in duplicates:
+        pks = list(keys.filter(key=key).order_by('pk')
+                   .values_list('pk', flat=True)[1:])
+        for pk in pks:
+            keys.filter(pk=pk).update(key=generate_key(keys))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invitation', '0005_invitationdelivery'),
+    ]
+
+    operations = [
+        migrations.RunPython(replace_duplicate_keys,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='invitationkey',
+            name='key',
+            field=models.CharField(max_length=40, unique=True,
+                                   verbose_name='invitation key'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invitation', '0006_invitationkey_key_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invitationkey',
+            index=models.Index(fields=['from_user', '-date_invited'],
+                               name='invitation_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invitationkey',
+            index=models.Index(fields=['recipient_email', 'expires_at'],
+                               name='invitation_recipient_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invitationkey',
+            index=models.Index(condition=models.Q(uses_left__gt=0),
+                               fields=['expires_at'],
+                               name='invitation_usable_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def groups_to_relation(apps, schema_editor):
+    InvitationKey = apps.get_model('invitation', 'InvitationKey')
+    Group = apps.get_model('auth', 'Group')
+    through = InvitationKey.groups.through
+    db = schema_editor.connection.alias
+    group_ids = dict(Group.objects.using(db).values_list('name', 'pk'))
+    keys = InvitationKey.objects.using(db).exclude(group_names='')\
+        .values_list('pk', 'group_names')
+    rows = []
+    for pk, names in keys.iterator():
+        ids = set(group_ids[name.strip()] for name in names.split(',')
+                  if name.strip() in group_ids)
+        rows.extend(through(invitationkey_id=pk, group_id=group_id)
+                    for group_id in ids)
+        if len(rows) >= 1000:
+            through.objects.using(db).bulk_create(rows)
+            rows = []
+    through.objects.using(db).bulk_create(rows)
+
+
+def relation_to_groups(apps, schema_editor):
+    InvitationKey = apps.get_model('invitation', 'InvitationKey')
+    db = schema_editor.connection.alias
+    for key in InvitationKey.objects.using(db).prefetch_related('groups')\
+            .exclude(groups=None).iterator():
+        key.group_names = ','.join(group.name for group in key.groups.all())
+        key.save(update_fields=['group_names'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0001_initial'),
+        ('invitation', '0007_invitationkey_indexes'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='invitationkey',
+            old_name='groups',
+            new_name='group_names',
+        ),
+        migrations.AddField(
+            model_name='invitationkey',
+            name='groups',
+            field=models.ManyToManyField(blank=True, related_name='+',
+                                         to='auth.Group'),
+        ),
+        migrations.RunPython(groups_to_relation, relation_to_groups),
+        migrations.RemoveField(
+            model_name='invitationkey',
+            name='group_names',
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Frees the ``invites_sent`` name for the ``InvitationUser.invites_sent()``
+    method again.  The column keeps its name, so only the state changes.
+    """
+
+    dependencies = [
+        ('invitation', '0008_invitationkey_groups_relation'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='invitationuser',
+                name='invites_sent',
+                field=models.IntegerField(db_column='invites_sent', default=0,
+                                          editable=False),
+            ),
+            migrations.RenameField(
+                model_name='invitationuser',
+                old_name='invites_sent',
+                new_name='invites_sent_count',
+            ),
+        ]),
+    ]
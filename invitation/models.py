@@ -1,5 +1,7 @@
 import datetime
-from django.db import models
+
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
@@ -8,14 +10,22 @@ from django.utils.timezone import now
 from django.urls import reverse
 from django.db import connection
 
-from invitation import utils
+from invitation import tickets, utils
+from invitation.cache import group_cache, remaining_cache
 from invitation.signals import (invite_invited, invite_accepted)
 
 
-token_generator = None
-if getattr(settings, 'INVITATION_USE_TOKEN', False):
-    generator_class = utils.get_token_generator_class()
-    token_generator = generator_class()
+def get_token_generator():
+    """
+    Return the token generator, or None unless ``INVITATION_USE_TOKEN`` is
+    set.  It's only imported when first needed.
+    """
+    if getattr(settings, 'INVITATION_USE_TOKEN', False):
+        return utils.get_token_generator()
+    return None
+
+
+key_cache = utils.get_key_cache()
 
 KEY_EMAIL = "recipient_email"
 KEY_FNAME = "recipient_first_name"
@@ -24,7 +34,59 @@ KEY_OTHER = "recipient_other"
 KEY_GROUPS = "groups"
 
 
-class InvitationKeyManager(models.Manager):
+def split_group_names(groups):
+    """
+    Return the group names in ``groups``, a comma separated string or a list.
+    """
+    if not groups:
+        return []
+    if isinstance(groups, str):
+        groups = groups.split(',')
+    return [name.strip() for name in groups if name and name.strip()]
+
+
+def add_user_to_groups(user, group_ids):
+    """
+    Add ``user`` to the groups ``group_ids`` with a single insert into the
+    through table, ignoring existing memberships.  ``m2m_changed`` isn't
+    sent.
+    """
+    related = user.groups
+    through = related.through
+    through.objects.bulk_create([
+        through(**{related.source_field_name + '_id': user.pk,
+                   related.target_field_name + '_id': group_id})
+        for group_id in set(group_ids)], ignore_conflicts=True)
+
+
+def get_shared_context(request=None):
+    """
+    Return the part of the invitation email context that is the same for
+    every recipient.
+    """
+    site, root_url = utils.get_site(request)
+    return {'site': site,
+            'root_url': root_url,
+            'expiration_days': settings.ACCOUNT_INVITATION_DAYS}
+
+
+class InvitationKeyQuerySet(models.QuerySet):
+    def usable(self):
+        """
+        Keys that have uses left and haven't expired.
+        """
+        not_expired = models.Q(expires_at__isnull=True) | \
+            models.Q(expires_at__gt=now())
+        return self.filter(not_expired, uses_left__gt=0)
+
+    def expired(self):
+        return self.filter(expires_at__lte=now())
+
+
+class InvitationKeyManager(models.Manager.from_queryset(InvitationKeyQuerySet)):
+    # number of times a generated key that is already taken is replaced
+    key_retries = 3
+
     def get_key(self, invitation_key):
         """
         Return InvitationKey, or None if it doesn't (or shouldn't) exist.
@@ -40,33 +102,126 @@ class InvitationKeyManager(models.Manager):
         """
         Check if an ``InvitationKey`` is valid or not, returning a valid key
         or false.
+
+        Results are remembered by the key cache (see
+        ``settings.INVITATION_KEY_CACHE``), both for valid keys and for keys
+        that don't exist or can't be used anymore.
         """
-        invitation_key = self.get_key(invitation_key)
-        if invitation_key and invitation_key.is_usable():
-            return invitation_key
+        hit, key = key_cache.get(invitation_key)
+        if not hit:
+            try:
+                key = self.usable().get(key=invitation_key)
+            except self.model.DoesNotExist:
+                key = None
+            if key and key.is_usable():
+                key_cache.set_valid(key)
+            else:
+                key_cache.set_invalid(invitation_key)
+        if key and key.is_usable():
+            return key
         return False
 
     def create_invitation(self, user, recipient_dict={
         KEY_EMAIL: 'recipient@email.com',
         KEY_FNAME: 'Firstname',
         KEY_LNAME: 'Lastname',
-    }, save=True):
+    }, save=True, reserve=False):
         """
         Create an ``InvitationKey`` and returns it.
 
         The key for the ``InvitationKey`` is generated by the function
         references byt settings.INVITATION_KEY_GENERATOR.  The default
-        implementation will be a SHA1 hash, generated from a combination of the
-        ``User``'s get_username() and a random salt.
+        implementation (``utils.generate_key``) returns a random string made
+        with ``secrets``.  If the key is already taken a new one is generated.
+
+        With ``reserve`` one of the user's invitations is reserved in the
+        same transaction (see ``InvitationUser.reserve_invites``) and None
+        is returned when there are none left.  Deleting the key releases the
+        reservation.
         """
-        generate_key = getattr(settings, 'INVITATION_KEY_GENERATOR',
-                               utils.get_invitation_key)
-        key = generate_key(user)
+        recipient_dict = dict(recipient_dict)
+        group_names = split_group_names(recipient_dict.pop(KEY_GROUPS, None))
         if not save:
             return InvitationKey(from_user=user, key='previewkey00000000',
                                  date_invited=datetime.datetime.now(),
                                  **recipient_dict)
-        return self.create(from_user=user, key=key, **recipient_dict)
+        for attempt in range(self.key_retries, -1, -1):
+            key, = utils.get_invitation_keys(user, 1)
+            invitation = self.model(from_user=user, key=key, **recipient_dict)
+            # tells the post_save handler that invites_sent_count is counted
+            invitation._invites_reserved = reserve
+            try:
+                with transaction.atomic():
+                    if reserve and not InvitationUser.reserve_invites(user):
+                        return None
+                    invitation.save(force_insert=True, using=self.db)
+                    self.add_groups([invitation], [group_names])
+                    return invitation
+            except IntegrityError:
+                if not attempt or not self.filter(key=key).exists():
+                    raise
+
+    def create_invitations(self, user, recipient_dicts):
+        """
+        Create an ``InvitationKey`` from ``user`` for every dict of
+        ``recipient_dicts`` with a single ``bulk_create`` and return them.
+
+        The keys are generated in one batch; keys that turn out to be taken
+        already are replaced and the insert retried.
+        """
+        keys = utils.get_invitation_keys(user, len(recipient_dicts))
+        invitations = []
+        group_names = []
+        for key, recipient_dict in zip(keys, recipient_dicts):
+            recipient_dict = dict(recipient_dict)
+            group_names.append(
+                split_group_names(recipient_dict.pop(KEY_GROUPS, None)))
+            invitation = self.model(from_user=user, key=key, **recipient_dict)
+            invitation.expires_at = invitation.compute_expires_at()
+            invitations.append(invitation)
+        if not invitations:
+            return invitations
+
+        for attempt in range(self.key_retries, -1, -1):
+            try:
+                with transaction.atomic():
+                    self.bulk_create(invitations)
+                break
+            except IntegrityError:
+                taken = set(self.filter(
+                    key__in=[invitation.key for invitation in invitations])
+                    .values_list('key', flat=True))
+                if not attempt or not taken:
+                    raise
+                replacements = iter(utils.get_invitation_keys(user,
+                                                              len(taken)))
+                for invitation in invitations:
+                    if invitation.key in taken:
+                        invitation.key = next(replacements)
+        # only some databases return the primary keys of bulk inserted rows
+        if invitations[0].pk is None:
+            keys = [invitation.key for invitation in invitations]
+            pks = dict(self.filter(key__in=keys).values_list('key', 'pk'))
+            for invitation in invitations:
+                invitation.pk = pks[invitation.key]
+        self.add_groups(invitations, group_names)
+        # bulk_create doesn't send post_save
+        InvitationUser.update_invites_sent(user, len(invitations))
+        remaining_cache.invalidate(user.pk)
+        return invitations
+
+    def add_groups(self, invitations, group_names):
+        """
+        Relate each of ``invitations`` to the groups named in the matching
+        list of ``group_names``, with a single insert.  Unknown names are
+        skipped.
+        """
+        through = self.model.groups.through
+        rows = [through(invitationkey_id=invitation.pk, group_id=group_id)
+                for invitation, names in zip(invitations, group_names)
+                for group_id in set(group_cache.get_ids(names))]
+        if rows:
+            through.objects.bulk_create(rows)
 
     # TODO: probably something different with 'recipient'
     def create_bulk_invitation(self, user, key, uses, recipient):
@@ -79,21 +234,52 @@ class InvitationKeyManager(models.Manager):
         """
         Return the number of remaining invitations for a given ``User``.
         """
-        invitation_user, _ = InvitationUser.objects.get_or_create(
-            inviter=user,
-            defaults={'invites_allocated': settings.INVITATIONS_PER_USER})
+        try:
+            invitation_user = InvitationUser.objects.get(inviter=user)
+        except InvitationUser.DoesNotExist:
+            # pre-existing/legacy user, count what was sent so far once
+            invitation_user, _ = InvitationUser.objects.get_or_create(
+                inviter=user,
+                defaults={'invites_allocated': settings.INVITATIONS_PER_USER,
+                          'invites_sent_count': user.invitations_sent.count()})
         return invitation_user.invites_remaining()
 
-    def delete_expired_keys(self):
-        for key in self.all():
-            if key.key_expired():
-                key.delete()
+    def delete_expired_keys(self, chunk_size=None, dry_run=False,
+                            progress=None):
+        """
+        Delete expired keys in batches of ``chunk_size`` (defaults to
+        ``settings.INVITATION_CLEANUP_CHUNK_SIZE``) and return how many were
+        deleted.  With ``dry_run`` the expired keys are only counted.
+
+        ``progress`` is called with the running total after every batch.
+        Deleting still sends ``post_delete`` for each key, so the token
+        generator cleans up after the keys of every batch.
+        """
+        expired = self.expired()
+        if dry_run:
+            return expired.count()
+
+        chunk_size = chunk_size or \
+            getattr(settings, 'INVITATION_CLEANUP_CHUNK_SIZE', 1000)
+        deleted = 0
+        while True:
+            pks = list(expired.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            with transaction.atomic():
+                self.filter(pk__in=pks).delete()
+            deleted += len(pks)
+            if progress:
+                progress(deleted)
+        return deleted
 
 
 class InvitationKey(models.Model):
-    key = models.CharField(_('invitation key'), max_length=40, db_index=True)
-    date_invited = models.DateTimeField(_('date invited'),
-                                        auto_now_add=True)
+    key = models.CharField(_('invitation key'), max_length=40, unique=True)
+    # set on instantiation (rather than auto_now_add) so expires_at can be
+    # computed before the row is written
+    date_invited = models.DateTimeField(_('date invited'), default=now,
+                                        editable=False)
     from_user = models.ForeignKey(settings.AUTH_USER_MODEL,
                                   on_delete=models.CASCADE,
                                   related_name='invitations_sent')
@@ -105,6 +291,9 @@ class InvitationKey(models.Model):
     # -1 duration means the key won't expire
     duration = models.IntegerField(default=settings.ACCOUNT_INVITATION_DAYS,
                                    null=True, blank=True)
+    # computed from date_invited and duration on save, null means never
+    expires_at = models.DateTimeField(_('expires at'), null=True, blank=True,
+                                      editable=False, db_index=True)
 
     objects = InvitationKeyManager()
 
@@ -115,13 +304,43 @@ class InvitationKey(models.Model):
                                            blank=True)
     recipient_other = models.CharField(max_length=255, default="", blank=True)
 
-    groups = models.TextField(default="", blank=True)
+    # groups the registrant is added to
+    groups = models.ManyToManyField(Group, blank=True, related_name='+')
+
+    class Meta:
+        indexes = [
+            # invitations of a sender, newest first (admin, quota counts)
+            models.Index(fields=['from_user', '-date_invited'],
+                         name='invitation_sender_idx'),
+            # outstanding invitations for an address
+            models.Index(fields=['recipient_email', 'expires_at'],
+                         name='invitation_recipient_idx'),
+            # usable keys by expiry date; skipped on databases without
+            # partial indexes, where the expires_at index is used instead
+            models.Index(fields=['expires_at'], name='invitation_usable_idx',
+                         condition=models.Q(uses_left__gt=0)),
+        ]
 
     def __str__(self):
         from_user = self.from_user.get_username()
         return "Invitation from %s on %s (%s)" % (from_user, self.date_invited,
                                                   self.key)
 
+    def save(self, *args, **kwargs):
+        self.expires_at = self.compute_expires_at()
+        super(InvitationKey, self).save(*args, **kwargs)
+
+    def compute_expires_at(self):
+        """
+        Return the expiry date for the current ``date_invited`` and
+        ``duration``, or None if the key never expires.
+        """
+        if self.duration is not None and self.duration < 0:
+            return None
+        expiration_duration = self.duration or settings.ACCOUNT_INVITATION_DAYS
+        return self.date_invited + \
+            datetime.timedelta(days=expiration_duration)
+
     def is_usable(self):
         """
         Return whether this key is still valid for registering a new user.
@@ -130,10 +349,8 @@ class InvitationKey(models.Model):
 
     def _expiry_date(self):
         # Assumes the duration is positive
-        assert self.duration > -1
-        expiration_duration = self.duration or settings.ACCOUNT_INVITATION_DAYS
-        expiration_date = datetime.timedelta(days=expiration_duration)
-        return self.date_invited + expiration_date
+        assert self.duration is None or self.duration > -1
+        return self.expires_at or self.compute_expires_at()
 
     def key_expired(self):
         """
@@ -147,13 +364,21 @@ class InvitationKey(models.Model):
         current date, the key has expired and this method returns ``True``.
 
         """
-        if self.duration < 0:
+        if self.duration is not None and self.duration < 0:
             return False
         return self._expiry_date() <= now()
     key_expired.boolean = True
 
+    def get_expiry_datetime(self):
+        """
+        Return the datetime this key expires at, or None if it never expires.
+        """
+        if self.duration is not None and self.duration < 0:
+            return None
+        return self._expiry_date()
+
     def expiry_date(self):
-        if self.duration < 0:
+        if self.duration is not None and self.duration < 0:
             return _('never')
         return self._expiry_date().strftime('%d %b %Y %H:%M')
     expiry_date.short_description = _('Expiry date')
@@ -161,52 +386,96 @@ class InvitationKey(models.Model):
     def mark_used(self, registrant):
         """
         Note that this key has been used to register a new user.
+
+        The use is taken with a single conditional UPDATE, so concurrent
+        signups can't use a key more often than it allows, and the counters
+        are updated with ``F()`` expressions in the same transaction.
+        Returns whether the use was granted.
         """
+        with transaction.atomic():
+            granted = InvitationKey.objects\
+                .filter(pk=self.pk, uses_left__gt=0)\
+                .update(uses_left=models.F('uses_left') - 1)
+            if granted:
+                self.registrant.add(registrant)
+                InvitationUser.update_invites_accepted(self.from_user_id, 1)
+        key_cache.invalidate(self.key)
+        if not granted:
+            return False
+        # other signups may have used the key meanwhile, this is only ours
         self.uses_left -= 1
-        self.registrant.add(registrant)
+        token_generator = get_token_generator()
         if token_generator:
             token_generator.handle_invitation_used(self)
         invite_accepted.send(sender=InvitationKey, invite_key=self)
-        self.from_user.invitationuser.increment_accepted()
-        self.save()
+        return True
 
-    def group_user(self, registrant):
+    def group_user(self, registrant, group_names=()):
         """
-        Add the user to any groups that have been stashed in the key
+        Add the user to the groups of the key, and to the groups named
+        ``group_names``, with a single insert.
         """
-        if self.groups is not None:
-            groups_qs = Group.objects.filter(name__in=self.groups.split(','))
-            group_list = [group for group in groups_qs]
-            registrant.groups.add(*group_list)
+        group_ids = set(self.groups.values_list('pk', flat=True))
+        group_ids.update(group_cache.get_ids(group_names))
+        add_user_to_groups(registrant, group_ids)
 
-    def get_context(self, extra_context={}):
-        site, root_url = utils.get_site()
-        invitation_url = root_url + reverse('invitation_invited',
-                                            kwargs={'invitation_key': self.key}
-                                            )
+    def get_context(self, extra_context={}, shared_context=None):
+        """
+        Return the context for the invitation email.  Pass the result of
+        ``get_shared_context()`` as ``shared_context`` when building the
+        context of many invitations.
+        """
+        if shared_context is None:
+            shared_context = get_shared_context()
+        invitation_url = shared_context['root_url'] + \
+            self.get_invitation_path()
         delta = datetime.timedelta(days=settings.ACCOUNT_INVITATION_DAYS)
         exp_date = self.date_invited + delta
-        context = {'invitation_key': self,
-                   'expiration_days': settings.ACCOUNT_INVITATION_DAYS,
-                   'from_user': self.from_user,
-                   'site': site,
-                   'root_url': root_url,
-                   'expiration_date': exp_date,
-                   'recipient_email': self.recipient_email,
-                   'recipient_first_name': self.recipient_first_name,
-                   'recipient_last_name': self.recipient_last_name,
-                   'recipient_other': self.recipient_other,
-                   'token': self.generate_token(invitation_url),
-                   'invitation_url': invitation_url}
+        context = dict(shared_context)
+        context.update({'invitation_key': self,
+                        'from_user': self.from_user,
+                        'expiration_date': exp_date,
+                        'recipient_email': self.recipient_email,
+                        'recipient_first_name': self.recipient_first_name,
+                        'recipient_last_name': self.recipient_last_name,
+                        'recipient_other': self.recipient_other,
+                        'token': self.generate_token(invitation_url),
+                        'invitation_url': invitation_url})
         context.update(extra_context)
         return context
 
-    def send_to(self, delivery_backend):
-        context = self.get_context()
+    def get_invitation_path(self):
+        """
+        Return the path of the invitation link, a signed link carrying the
+        key, the recipient and the expiry date when
+        ``settings.INVITATION_SIGNED_LINKS`` is set.
+        """
+        if getattr(settings, 'INVITATION_SIGNED_LINKS', False):
+            ticket = tickets.make_ticket(self, self.recipient_email)
+            return reverse('invitation_invited_signed',
+                           kwargs={'ticket': ticket})
+        return reverse('invitation_invited',
+                       kwargs={'invitation_key': self.key})
+
+    def send_to(self, delivery_backend, request=None):
+        """
+        Send this invitation with ``delivery_backend``, or only queue it if
+        ``settings.INVITATION_DELIVERY_QUEUE`` is set.  The links point to
+        the site and scheme of ``request`` when given.
+        """
+        queue = utils.get_delivery_queue()
+        if queue:
+            queue.enqueue([self], delivery_backend, request)
+        else:
+            self.deliver(delivery_backend, get_shared_context(request))
+
+    def deliver(self, delivery_backend, shared_context=None):
+        context = self.get_context(shared_context=shared_context)
         delivery_backend.send_invitation(context)
         invite_invited.send(sender=InvitationKey, invite_key=self)
 
     def generate_token(self, invitation_url):
+        token_generator = get_token_generator()
         if token_generator:
             return token_generator.generate_token(self, invitation_url)
 
@@ -227,30 +496,70 @@ class InvitationUser(models.Model):
     invites_allocated = \
         models.IntegerField(default=settings.INVITATIONS_PER_USER)
     invites_accepted = models.IntegerField(default=0)
+    # kept up to date by the InvitationKey post_save/post_delete handlers
+    invites_sent_count = models.IntegerField(default=0, editable=False,
+                                             db_column='invites_sent')
 
     def __str__(self):
         return "InvitationUser for %s" % self.inviter.get_username()
 
     def increment_accepted(self):
+        InvitationUser.update_invites_accepted(self.inviter_id, 1)
         self.invites_accepted += 1
-        self.save()
+
+    @classmethod
+    def create_missing(cls, users=None, chunk_size=1000):
+        """
+        Create the missing InvitationUser of ``users`` (all users by default)
+        with ``bulk_create``, ``chunk_size`` rows at a time.  Returns the
+        number of rows created.
+        """
+        if users is None:
+            users = get_user_model().objects.all()
+        missing = users.filter(invitationuser__isnull=True).order_by('pk')\
+            .annotate(sent=models.Count('invitations_sent'))\
+            .values_list('pk', 'sent')
+        created = 0
+        while True:
+            batch = list(missing[:chunk_size])
+            if not batch:
+                break
+            # rows created concurrently are skipped by ignore_conflicts, so
+            # only count the rows that are new after the insert
+            existing = cls.objects.filter(
+                inviter_id__in=[pk for pk, sent in batch])
+            before = existing.count()
+            cls.objects.bulk_create(
+                [cls(inviter_id=pk, invites_sent_count=sent,
+                     invites_allocated=settings.INVITATIONS_PER_USER)
+                 for pk, sent in batch],
+                ignore_conflicts=True)
+            created += existing.count() - before
+        return created
 
     @classmethod
     def add_invites_to_user(cls, user, num_invites):
-        invite_user, _ = InvitationUser.objects.get_or_create(user=user)
+        invite_user, _ = cls.objects.get_or_create(inviter=user)
         if invite_user.invites_allocated != -1:
             invite_user.invites_allocated += num_invites
             invite_user.save()
 
     @classmethod
     def add_invites(cls, num_invites):
-        for user in get_user_model().objects.all():
-            cls.add_invites(user, num_invites)
+        """
+        Add ``num_invites`` to every user without infinite invites, with a
+        single UPDATE.  Returns the number of users updated.
+        """
+        cls.create_missing()
+        updated = cls.objects.exclude(invites_allocated=-1).update(
+            invites_allocated=models.F('invites_allocated') + num_invites)
+        remaining_cache.invalidate()
+        return updated
 
     @classmethod
     def topoff_user(cls, user, num_invites):
         "Makes sure user has a certain number of invites"
-        invite_user, _ = cls.objects.get_or_create(user=user)
+        invite_user, _ = cls.objects.get_or_create(inviter=user)
         remaining = invite_user.invites_remaining()
         if remaining != -1 and remaining < num_invites:
             invite_user.invites_allocated += (num_invites - remaining)
@@ -258,25 +567,140 @@ class InvitationUser(models.Model):
 
     @classmethod
     def topoff(cls, num_invites):
-        "Makes sure all users have a certain number of invites"
-        for user in get_user_model().objects.all():
-            cls.topoff_user(user, num_invites)
+        """
+        Makes sure all users have a certain number of invites, with a single
+        UPDATE of the users that have less.  Returns the number of users
+        updated.
+        """
+        cls.create_missing()
+        topped_off = models.F('invites_sent_count') + num_invites
+        updated = cls.objects.exclude(invites_allocated=-1)\
+            .filter(invites_allocated__lt=topped_off)\
+            .update(invites_allocated=topped_off)
+        remaining_cache.invalidate()
+        return updated
+
+    @classmethod
+    def make_infinite(cls, users=None, chunk_size=1000):
+        """
+        Give ``users`` (all users by default) infinite invites with a single
+        UPDATE.  Returns the number of users updated.
+        """
+        cls.create_missing(users, chunk_size)
+        invitation_users = cls.objects.exclude(invites_allocated=-1)
+        if users is not None:
+            invitation_users = invitation_users.filter(inviter__in=users)
+        updated = invitation_users.update(invites_allocated=-1)
+        remaining_cache.invalidate()
+        return updated
+
+    @classmethod
+    def update_invites_sent(cls, user, num_invites):
+        """
+        Atomically add ``num_invites`` (which may be negative) to the
+        ``invites_sent_count`` counter of ``user``.
+        """
+        sent = models.F('invites_sent_count') + num_invites
+        cls.objects.filter(inviter=user).update(invites_sent_count=sent)
+
+    @classmethod
+    def reserve_invites(cls, user, num_invites=1):
+        """
+        Count ``num_invites`` more invitations as sent by ``user`` if their
+        allocation allows it, with a single conditional UPDATE so that
+        parallel requests can't exceed it.  Returns whether the invitations
+        were reserved.
+        """
+        sent = models.F('invites_sent_count') + num_invites
+        has_room = models.Q(invites_allocated=-1) | \
+            models.Q(invites_allocated__gte=sent)
+        for attempt in range(2):
+            reserved = cls.objects.filter(has_room, inviter=user).update(
+                invites_sent_count=sent)
+            if reserved or attempt or \
+                    cls.objects.filter(inviter=user).exists():
+                break
+            # pre-existing/legacy user without an InvitationUser yet
+            InvitationKey.objects.remaining_invitations_for_user(user)
+        remaining_cache.invalidate(getattr(user, 'pk', user))
+        return bool(reserved)
+
+    @classmethod
+    def update_invites_accepted(cls, user, num_invites):
+        """
+        Atomically add ``num_invites`` to the ``invites_accepted`` counter of
+        ``user``.
+        """
+        cls.objects.filter(inviter=user).update(
+            invites_accepted=models.F('invites_accepted') + num_invites)
+
+    @classmethod
+    def reconcile_invites_sent(cls, chunk_size=1000):
+        """
+        Recompute ``invites_sent_count`` from the keys in the database, one range of
+        ``chunk_size`` rows per UPDATE.  Returns the number of rows updated.
+        """
+        sent = InvitationKey.objects\
+            .filter(from_user=models.OuterRef('inviter')).order_by()\
+            .values('from_user').annotate(count=models.Count('pk'))\
+            .values('count')
+        invites_sent = Coalesce(models.Subquery(sent), 0)
+        last_pk = cls.objects.aggregate(last_pk=models.Max('pk'))['last_pk']
+        updated = 0
+        for start in range(0, (last_pk or 0) + 1, chunk_size):
+            updated += cls.objects\
+                .filter(pk__gte=start, pk__lt=start + chunk_size)\
+                .update(invites_sent_count=invites_sent)
+        return updated
+
+    def invites_sent(self):
+        return self.invites_sent_count
 
     def invites_remaining(self):
         if self.invites_allocated == -1:
             return -1
-        return self.invites_allocated - self.invites_sent()
-
-    def invites_sent(self):
-        return self.inviter.invitations_sent.count()
+        return self.invites_allocated - self.invites_sent_count
 
     def can_send(self):
         if self.invites_allocated == -1:
             return True
-        return self.invites_allocated > self.invites_sent()
+        return self.invites_allocated > self.invites_sent_count
     can_send.boolean = True
 
 
+class InvitationDelivery(models.Model):
+    """
+    A queued delivery of an invitation, used by
+    ``invitation.queue.DatabaseDeliveryQueue``.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, _('pending')),
+        (SENT, _('sent')),
+        (DEAD, _('dead')),
+    )
+
+    invitation = models.ForeignKey(InvitationKey, on_delete=models.CASCADE,
+                                   related_name='deliveries')
+    # dotted path and JSON encoded data of the delivery backend
+    backend = models.CharField(max_length=255)
+    data = models.TextField(default='', blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=now)
+    last_error = models.TextField(default='', blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = (('status', 'next_attempt'),)
+
+    def __str__(self):
+        return "Delivery of %s (%s)" % (self.invitation_id, self.status)
+
+
 # TODO: check to see if there is an outstanding invite for this user
 # to see if we need to trigger the independently_joined signal
 def user_post_save(sender, instance, created, **kwargs):
@@ -294,22 +718,38 @@ def user_post_save(sender, instance, created, **kwargs):
 models.signals.post_save.connect(user_post_save,
                                  sender=settings.AUTH_USER_MODEL)
 
-# def invitation_key_post_save(sender, instance, created, **kwargs):
-#     """Decrement invitations_remaining when InvitationKey is created."""
-#    objs = InvitationUser.objects
-#     if created:
-#         invitation_user = objs.get(inviter=instance.from_user)
-#         remaining = invitation_user.invitations_remaining
-#         invitation_user.invitations_remaining = remaining-1
-#         invitation_user.save()
 
-# models.signals.post_save.connect(invitation_key_post_save,
-#                                sender=InvitationKey)
+def invitation_user_post_save(sender, instance, **kwargs):
+    remaining_cache.invalidate(instance.inviter_id)
+
+models.signals.post_save.connect(invitation_user_post_save,
+                                 sender=InvitationUser)
+
+
+def invitation_key_post_save(sender, instance, created, **kwargs):
+    """
+    Forget any cached validation result when an InvitationKey changes and
+    count new keys in the sender's invites_sent_count.
+    """
+    key_cache.invalidate(instance.key)
+    if created and not getattr(instance, '_invites_reserved', False):
+        InvitationUser.update_invites_sent(instance.from_user_id, 1)
+        remaining_cache.invalidate(instance.from_user_id)
+
+models.signals.post_save.connect(invitation_key_post_save,
+                                 sender=InvitationKey)
 
 
 def invitation_key_pre_delete(sender, instance, **kwargs):
+    key_cache.invalidate(instance.key)
+    InvitationUser.update_invites_sent(instance.from_user_id, -1)
+    remaining_cache.invalidate(instance.from_user_id)
+    token_generator = get_token_generator()
     if token_generator:
-        token_generator.handle_invitation_deleted(instance)
+        token_generator.handle_invitation_delete(instance)
 
 models.signals.post_delete.connect(invitation_key_pre_delete,
                                    sender=InvitationKey)
+
+models.signals.post_save.connect(group_cache.invalidate, sender=Group)
+models.signals.post_delete.connect(group_cache.invalidate, sender=Group)
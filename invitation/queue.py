@@ -0,0 +1,182 @@
+import datetime
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.safestring import SafeData, mark_safe
+from django.utils.timezone import now
+
+from invitation import utils
+from invitation.models import InvitationDelivery, get_shared_context
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# data key listing the values that were marked safe, e.g. the bulk view's
+# sender note, so the worker renders them like a synchronous send
+SAFE_KEYS = '__safe__'
+# data key holding the root URL of the site the invitation was sent from
+ROOT_URL_KEY = '__root_url__'
+
+
+class DeliveryDataEncoder(DjangoJSONEncoder):
+    """
+    Coerces what ``json`` can't serialize: iterables (sets, querysets) to
+    lists and anything else (e.g. model instances) to strings.
+    """
+
+    def default(self, o):
+        try:
+            return super(DeliveryDataEncoder, self).default(o)
+        except TypeError:
+            if isinstance(o, (set, frozenset, tuple)) or \
+                    hasattr(o, 'iterator'):
+                return list(o)
+            return str(o)
+
+
+def dump_data(data, root_url=None):
+    """
+    Return the delivery backend ``data`` as JSON, remembering which values
+    were marked safe and the ``root_url`` of the site the invitation was
+    sent from.
+    """
+    data = dict(data)
+    if root_url:
+        data[ROOT_URL_KEY] = root_url
+    safe_keys = sorted(key for key, value in data.items()
+                       if isinstance(value, SafeData))
+    if safe_keys:
+        data[SAFE_KEYS] = safe_keys
+    return json.dumps(data, cls=DeliveryDataEncoder)
+
+
+def load_data(data):
+    """
+    Return the delivery backend data and the root URL stored by
+    ``dump_data``.
+    """
+    data = json.loads(data or '{}')
+    for key in data.pop(SAFE_KEYS, ()):
+        if isinstance(data.get(key), str):
+            data[key] = mark_safe(data[key])
+    return data, data.pop(ROOT_URL_KEY, None)
+
+
+class BaseDeliveryQueue():
+    """
+    Base class for delivery queues.  When ``settings.INVITATION_DELIVERY_QUEUE``
+    is set, ``InvitationKey.send_to`` only enqueues the invitation and a worker
+    (``manage.py process_invitation_queue``) delivers it later.  To create a
+    custom queue, inherit from this class and implement the methods.
+    """
+
+    def enqueue(self, invitations, delivery_backend, request=None):
+        """
+        Queue ``invitations``; the links should point to the site and scheme
+        of ``request`` when given.
+        """
+        raise NotImplementedError("Create a subclass and implement method")
+
+    def process(self, batch_size=100):
+        """
+        Deliver up to ``batch_size`` queued invitations and return a
+        ``(sent, failed)`` tuple.
+        """
+        raise NotImplementedError("Create a subclass and implement method")
+
+
+class DatabaseDeliveryQueue(BaseDeliveryQueue):
+    """
+    Queue stored in the ``InvitationDelivery`` table, no broker needed.
+
+    Failed deliveries are retried after ``INVITATION_DELIVERY_RETRY_DELAY``
+    seconds, doubling the delay after every attempt.  After
+    ``INVITATION_DELIVERY_MAX_ATTEMPTS`` attempts the delivery is marked dead.
+    """
+
+    @property
+    def max_attempts(self):
+        return getattr(settings, 'INVITATION_DELIVERY_MAX_ATTEMPTS', 5)
+
+    @property
+    def retry_delay(self):
+        return getattr(settings, 'INVITATION_DELIVERY_RETRY_DELAY', 60)
+
+    @property
+    def lease_time(self):
+        # how long a claimed delivery is hidden from other workers
+        return getattr(settings, 'INVITATION_DELIVERY_LEASE_TIME', 300)
+
+    def enqueue(self, invitations, delivery_backend, request=None):
+        backend_class = delivery_backend.__class__
+        backend = '%s.%s' % (backend_class.__module__, backend_class.__name__)
+        root_url = None
+        if request is not None:
+            root_url = utils.get_site(request)[1]
+        data = dump_data(delivery_backend.data, root_url)
+        InvitationDelivery.objects.bulk_create([
+            InvitationDelivery(invitation=invitation, backend=backend,
+                               data=data)
+            for invitation in invitations])
+
+    def claim(self, batch_size):
+        """
+        Return up to ``batch_size`` due deliveries, leased to this worker.
+
+        Each delivery is claimed with a conditional UPDATE so that concurrent
+        workers never get the same one, on any database.
+        """
+        due = InvitationDelivery.objects.select_related('invitation')\
+            .filter(status=InvitationDelivery.PENDING,
+                    next_attempt__lte=now())\
+            .order_by('next_attempt')[:batch_size]
+        lease = now() + datetime.timedelta(seconds=self.lease_time)
+        claimed = []
+        for delivery in due:
+            updated = InvitationDelivery.objects\
+                .filter(pk=delivery.pk, status=InvitationDelivery.PENDING,
+                        next_attempt=delivery.next_attempt)\
+                .update(next_attempt=lease)
+            if updated:
+                delivery.next_attempt = lease
+                claimed.append(delivery)
+        return claimed
+
+    def deliver(self, delivery):
+        """
+        Try to send ``delivery`` and record the outcome.  Returns whether
+        it was sent.
+        """
+        delivery.attempts += 1
+        try:
+            backend_class = utils.str_to_class(delivery.backend)
+            data, root_url = load_data(delivery.data)
+            shared_context = get_shared_context()
+            if root_url:
+                shared_context['root_url'] = root_url
+            delivery.invitation.deliver(backend_class(data), shared_context)
+        except Exception as e:
+            logger.exception("Delivery %s failed", delivery.pk)
+            delivery.last_error = repr(e)
+            if delivery.attempts >= self.max_attempts:
+                delivery.status = InvitationDelivery.DEAD
+            else:
+                delay = self.retry_delay * 2 ** (delivery.attempts - 1)
+                delivery.next_attempt = \
+                    now() + datetime.timedelta(seconds=delay)
+            delivery.save()
+            return False
+        delivery.status = InvitationDelivery.SENT
+        delivery.save()
+        return True
+
+    def process(self, batch_size=100):
+        sent = failed = 0
+        for delivery in self.claim(batch_size):
+            if self.deliver(delivery):
+                sent += 1
+            else:
+                failed += 1
+        return sent, failed
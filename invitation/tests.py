@@ -17,17 +17,42 @@ getting django-invitation running in the default setup, to wit:
 """
 
 import datetime
+import json
 from hashlib import sha1 as sha
+import smtplib
+from io import StringIO
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
 
 from django.conf import settings
+from django.contrib.auth.models import Group
 from django.contrib.sites.models import Site
 from django.core import mail, management
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.core.mail.backends import locmem
+from django.template import Context, Template
+from django.db import IntegrityError, OperationalError, connection
 from django.urls import reverse
-from django.test import TestCase
-
-from invitation import forms
-from invitation.backends import EmailDeliveryBackend
-from invitation.models import InvitationKey, InvitationUser
+from django.test import (Client, RequestFactory, TestCase,
+                         TransactionTestCase)
+from django.utils import translation
+from django.utils.safestring import mark_safe
+from django.utils.timezone import now
+
+from invitation import (context_processors, forms, tickets, tokens, utils,
+                        views)
+from invitation.backends import EmailDeliveryBackend, InvitationMixin
+from invitation.cache import DummyKeyCache, group_cache
+from invitation.mail import ConnectionPool
+from invitation.utils import DefaultTokenGenerator
+from invitation.models import (InvitationDelivery, InvitationKey,
+                               InvitationUser)
 from django.test.utils import override_settings
 
 
@@ -56,6 +81,30 @@ except:
     pass
 
 
+class FailingEmailBackend(locmem.EmailBackend):
+    """Refuses to send mail to addresses at fail.example.com."""
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.to[0].endswith('@fail.example.com'):
+                raise IOError("Mail server refused %s" % message.to[0])
+        return super(FailingEmailBackend, self).send_messages(messages)
+
+
+class DisconnectingEmailBackend(locmem.EmailBackend):
+    """Behaves like a server that dropped the first connection."""
+    connections = 0
+
+    def open(self):
+        DisconnectingEmailBackend.connections += 1
+        self.dropped = DisconnectingEmailBackend.connections == 1
+
+    def send_messages(self, messages):
+        if self.dropped:
+            raise smtplib.SMTPServerDisconnected()
+        return super(DisconnectingEmailBackend, self).send_messages(messages)
+
+
 class InvitationTestCase(TestCase):
     """
     Base class for the test cases.
@@ -67,6 +116,7 @@ class InvitationTestCase(TestCase):
     fixtures = ['testserver.json']
 
     def setUp(self):
+        cache.clear()
         self.sample_user = User.objects.create_user(username='alice',
                                                     password='secret',
                                                     email='alice@example.com')
@@ -170,6 +220,90 @@ class InvitationModelTests(InvitationTestCase):
         self.sample_key.send_to(delivery)
         self.assertEqual(len(mail.outbox), 1)
 
+    @override_settings(
+        INVITATION_DELIVERY_QUEUE='invitation.queue.DatabaseDeliveryQueue',
+        INVITATION_DELIVERY_MAX_ATTEMPTS=2,
+        EMAIL_BACKEND='invitation.tests.FailingEmailBackend')
+    def test_invitation_delivery_queue(self):
+        """
+        Test that with a delivery queue ``send_to`` only queues the email,
+        which ``manage.py process_invitation_queue`` sends, retrying failed
+        deliveries until they are dead.
+
+        """
+        delivery = EmailDeliveryBackend({'sender_note': 'Hi'})
+        self.sample_key.send_to(delivery)
+        failing_key = InvitationKey.objects.create_invitation(
+            self.sample_user, {'recipient_email': 'bob@fail.example.com'})
+        failing_key.send_to(delivery)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(InvitationDelivery.objects.count(), 2)
+
+        management.call_command('process_invitation_queue', verbosity=0)
+        self.assertEqual(len(mail.outbox), 1)
+        sent = InvitationDelivery.objects.get(status=InvitationDelivery.SENT)
+        self.assertEqual(sent.attempts, 1)
+        failed = InvitationDelivery.objects.get(
+            status=InvitationDelivery.PENDING)
+        self.assertEqual(failed.attempts, 1)
+        self.assertTrue(failed.next_attempt > now())
+
+        InvitationDelivery.objects.update(next_attempt=now())
+        management.call_command('process_invitation_queue', verbosity=0)
+        failed.refresh_from_db()
+        self.assertEqual(failed.status, InvitationDelivery.DEAD)
+        self.assertIn('bob@fail.example.com', failed.last_error)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_queued_delivery_data(self):
+        """
+        Test that a queued invitation renders the sender note like a
+        synchronous one, and that data json can't serialize is coerced when
+        it's queued.
+
+        """
+        data = {'sender_note': mark_safe('<b>Welcome</b>'),
+                'from_email': 'team@example.com',
+                'tags': set(['beta'])}
+        self.sample_key.send_to(EmailDeliveryBackend(data))
+        with self.settings(INVITATION_DELIVERY_QUEUE=
+                           'invitation.queue.DatabaseDeliveryQueue'):
+            self.sample_key.send_to(EmailDeliveryBackend(data))
+            queued = InvitationDelivery.objects.get()
+            self.assertEqual(json.loads(queued.data)['tags'], ['beta'])
+            management.call_command('process_invitation_queue', verbosity=0)
+        self.assertEqual(len(mail.outbox), 2)
+        sync_html, queued_html = [message.alternatives[0][0]
+                                  for message in mail.outbox]
+        self.assertIn('<b>Welcome</b>', sync_html)
+        self.assertEqual(queued_html, sync_html)
+        self.assertEqual(mail.outbox[1].from_email, 'team@example.com')
+
+    def test_connection_pool(self):
+        """
+        Test that the connection pool reuses connections, replaces idle ones
+        and reconnects when the server dropped the connection.
+
+        """
+        message = mail.EmailMessage('Hi', 'Hi', to=['bob@example.com'])
+
+        pool = ConnectionPool(max_connections=1)
+        for i in range(3):
+            pool.send_messages([message])
+        metrics = pool.get_metrics()
+        self.assertEqual((metrics['opened'], metrics['reused']), (1, 2))
+
+        pool = ConnectionPool(max_connections=1, idle_timeout=0)
+        pool.send_messages([message])
+        pool.send_messages([message])
+        self.assertEqual(pool.get_metrics()['expired'], 1)
+
+        pool = ConnectionPool('invitation.tests.DisconnectingEmailBackend')
+        pool.send_messages([message])
+        metrics = pool.get_metrics()
+        self.assertEqual((metrics['reconnects'], metrics['failures']), (1, 0))
+        self.assertEqual(len(mail.outbox), 6)
+
     def test_key_expiration_condition(self):
         """
         Test that ``InvitationKey.key_expired()`` returns ``True`` for expired
@@ -193,6 +327,54 @@ class InvitationModelTests(InvitationTestCase):
         InvitationKey.objects.delete_expired_keys()
         self.assertEqual(InvitationKey.objects.count(), 1)
 
+    def test_usable_keys(self):
+        """
+        Test that ``expires_at`` is stored on save and that ``usable()``
+        filters out expired and used up keys in the database.
+
+        """
+        self.assertEqual(self.sample_key.expires_at,
+                         self.sample_key.date_invited + datetime.timedelta(
+                             days=settings.ACCOUNT_INVITATION_DAYS))
+        never = InvitationKey.objects.create_invitation(user=self.sample_user)
+        never.duration = -1
+        never.save()
+        self.assertIsNone(never.expires_at)
+        used = InvitationKey.objects.create_invitation(user=self.sample_user)
+        used.uses_left = 0
+        used.save()
+
+        self.assertEqual(set(InvitationKey.objects.usable()),
+                         set([self.sample_key, never]))
+        self.assertEqual(list(InvitationKey.objects.expired()),
+                         [self.expired_key])
+
+    def test_expired_key_deletion_in_batches(self):
+        """
+        Test that keys which never expire are kept, that an empty duration
+        falls back to ``ACCOUNT_INVITATION_DAYS`` and that a dry run deletes
+        nothing.
+
+        """
+        objs = InvitationKey.objects
+        d = settings.ACCOUNT_INVITATION_DAYS + 1
+        never = objs.create_invitation(user=self.sample_user)
+        no_duration = objs.create_invitation(user=self.sample_user)
+        for key, duration in ((never, -1), (no_duration, None)):
+            key.date_invited -= datetime.timedelta(days=d)
+            key.duration = duration
+            key.save()
+
+        self.assertEqual(objs.delete_expired_keys(dry_run=True), 2)
+        self.assertEqual(objs.count(), 4)
+
+        batches = []
+        deleted = objs.delete_expired_keys(chunk_size=1,
+                                           progress=batches.append)
+        self.assertEqual(deleted, 2)
+        self.assertEqual(batches, [1, 2])
+        self.assertEqual(set(objs.all()), set([self.sample_key, never]))
+
     def test_management_command(self):
         """
         Test that ``manage.py cleanupinvitation`` functions correctly.
@@ -201,6 +383,30 @@ class InvitationModelTests(InvitationTestCase):
         management.call_command('cleanupinvitation')
         self.assertEqual(InvitationKey.objects.count(), 1)
 
+    def test_key_validation_cache(self):
+        """
+        Test that ``is_key_valid`` caches valid and unknown keys and that
+        using or deleting a key invalidates the cached result.
+
+        """
+        is_key_valid = InvitationKey.objects.is_key_valid
+        self.assertEqual(is_key_valid(self.sample_key.key), self.sample_key)
+        with self.assertNumQueries(0):
+            self.assertEqual(is_key_valid(self.sample_key.key),
+                             self.sample_key)
+
+        self.assertFalse(is_key_valid('bogus'))
+        with self.assertNumQueries(0):
+            self.assertFalse(is_key_valid('bogus'))
+
+        self.sample_key.mark_used(self.sample_user)
+        self.assertFalse(is_key_valid(self.sample_key.key))
+
+        key = InvitationKey.objects.create_invitation(user=self.sample_user)
+        self.assertEqual(is_key_valid(key.key), key)
+        key.delete()
+        self.assertFalse(is_key_valid(key.key))
+
     def test_invitations_remaining(self):
         """Test InvitationUser calculates remaining invitations properly."""
         objs = InvitationKey.objects
@@ -238,6 +444,325 @@ class InvitationModelTests(InvitationTestCase):
 
         old_sample_user.invitationuser.delete()
 
+    def test_invites_sent_counter(self):
+        """
+        Test that ``invites_sent`` follows key creation and deletion and that
+        ``manage.py reconcile_invites`` repairs it.
+
+        """
+        def invites_sent():
+            return InvitationUser.objects.get(
+                inviter=self.sample_user).invites_sent()
+
+        self.assertEqual(invites_sent(), 2)
+        key = InvitationKey.objects.create_invitation(user=self.sample_user)
+        self.assertEqual(invites_sent(), 3)
+        key.delete()
+        self.assertEqual(invites_sent(), 2)
+
+        invitation_user = InvitationUser.objects.get(inviter=self.sample_user)
+        self.assertEqual(invitation_user.invites_sent_count, 2)
+        self.assertEqual(invitation_user.invites_remaining(),
+                         settings.INVITATIONS_PER_USER - 2)
+        InvitationUser.objects.update(invites_sent_count=42)
+        management.call_command('reconcile_invites', verbosity=0)
+        self.assertEqual(invites_sent(), 2)
+
+    def test_remaining_invitations_context_processor(self):
+        """
+        Test that the ``remaining_invitations`` context processor only queries
+        the database when the value is used, once per request.
+
+        """
+        request = RequestFactory().get('/')
+        request.user = self.sample_user
+        with self.assertNumQueries(0):
+            context = context_processors.remaining_invitations(request)
+        remaining = settings.INVITATIONS_PER_USER - 2
+        self.assertEqual(context['remaining_invitations'], remaining)
+        context = context_processors.remaining_invitations(request)
+        with self.assertNumQueries(0):
+            self.assertEqual(context['remaining_invitations'], remaining)
+
+        template = Template(
+            '{% load i18n %}{% if remaining_invitations >= 1 %}some'
+            '{% endif %} {{ remaining_invitations|add:1 }} '
+            '{% blocktrans count counter=remaining_invitations %}'
+            '{{ counter }} invite{% plural %}{{ counter }} invites'
+            '{% endblocktrans %}')
+        self.assertEqual(remaining, 1)
+        self.assertEqual(template.render(Context(context)), 'some 2 1 invite')
+
+    @override_settings(INVITATION_REMAINING_CACHE_TIMEOUT=60)
+    def test_remaining_invitations_cache(self):
+        """
+        Test that cached remaining invitations are invalidated when the user
+        sends an invitation.
+
+        """
+        def remaining_invitations():
+            request = RequestFactory().get('/')
+            request.user = self.sample_user
+            context = context_processors.remaining_invitations(request)
+            return context['remaining_invitations']
+
+        remaining = settings.INVITATIONS_PER_USER - 2
+        self.assertEqual(remaining_invitations(), remaining)
+        with self.assertNumQueries(0):
+            self.assertEqual(remaining_invitations(), remaining)
+        InvitationKey.objects.create_invitation(user=self.sample_user)
+        self.assertEqual(remaining_invitations(), remaining - 1)
+
+    def test_topoff_and_add_invites(self):
+        """
+        Test that ``manage.py topoff_invites`` and ``manage.py add_invites``
+        update every user, creating missing InvitationUsers, and leave users
+        with infinite invites alone.
+
+        """
+        bob = User.objects.create_user(username='bob', password='secret',
+                                       email='bob@example.com')
+        bob.invitationuser.delete()
+        carol = User.objects.create_user(username='carol', password='secret',
+                                         email='carol@example.com')
+        InvitationUser.objects.filter(inviter=carol)\
+            .update(invites_allocated=-1)
+
+        def allocated(user):
+            return InvitationUser.objects.get(inviter=user).invites_allocated
+
+        management.call_command('topoff_invites', '5', verbosity=0)
+        self.assertEqual(allocated(self.sample_user), 7)
+        self.assertEqual(allocated(bob), 5)
+        self.assertEqual(allocated(carol), -1)
+
+        management.call_command('add_invites', '2', verbosity=0)
+        self.assertEqual(allocated(self.sample_user), 9)
+        self.assertEqual(allocated(bob), 7)
+        self.assertEqual(allocated(carol), -1)
+
+    def test_infinite_invites(self):
+        """
+        Test that ``manage.py infinite_invites`` can be limited to staff.
+
+        """
+        staff = User.objects.create_user(username='bob', password='secret',
+                                         email='bob@example.com',
+                                         is_staff=True)
+        staff.invitationuser.delete()
+
+        management.call_command('infinite_invites', staff=True, verbosity=0)
+        self.assertEqual(InvitationUser.objects.get(inviter=staff)
+                         .invites_allocated, -1)
+        self.assertEqual(self.sample_user.invitationuser.invites_allocated,
+                         settings.INVITATIONS_PER_USER)
+
+        management.call_command('infinite_invites', verbosity=0)
+        self.assertFalse(InvitationUser.objects
+                         .exclude(invites_allocated=-1).exists())
+
+    def test_create_missing_count(self):
+        """
+        Test that ``InvitationUser.create_missing`` only counts the rows it
+        created, not the ones created concurrently.
+
+        """
+        bob = User.objects.create_user(username='bob', password='secret')
+        carol = User.objects.create_user(username='carol', password='secret')
+        InvitationUser.objects.filter(inviter__in=[bob, carol]).delete()
+        objects_filter = InvitationUser.objects.filter
+
+        def racing_filter(*args, **kwargs):
+            # another process creates bob's row after the missing users
+            # were read
+            if not objects_filter(inviter=bob).exists():
+                InvitationUser.objects.create(inviter=bob)
+            return objects_filter(*args, **kwargs)
+
+        with mock.patch.object(InvitationUser.objects, 'filter',
+                               racing_filter):
+            self.assertEqual(InvitationUser.create_missing(), 1)
+        self.assertEqual(InvitationUser.objects.filter(
+            inviter__in=[bob, carol]).count(), 2)
+        self.assertEqual(InvitationUser.create_missing(), 0)
+
+    @override_settings(
+        EMAIL_BACKEND='invitation.tests.FailingEmailBackend',
+        INVITATION_DELIVERY_BACKEND='invitation.backends.EmailDeliveryBackend')
+    def test_reservation_released(self):
+        """
+        Test that the invite view reserves an invitation, and releases it
+        when the email can't be sent.
+
+        """
+        objs = InvitationKey.objects
+        remaining = objs.remaining_invitations_for_user(self.sample_user)
+        self.client.login(username='alice', password='secret')
+        response = self.client.post(reverse('invitation_invite'),
+                                    data={'email': 'bob@fail.example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].non_field_errors())
+        self.assertFalse(objs.filter(
+            recipient_email='bob@fail.example.com').exists())
+        self.assertEqual(objs.remaining_invitations_for_user(self.sample_user),
+                         remaining)
+
+        response = self.client.post(reverse('invitation_invite'),
+                                    data={'email': 'bob@example.com'})
+        self.assertRedirect(response, 'invitation_complete')
+        self.assertEqual(objs.remaining_invitations_for_user(self.sample_user),
+                         remaining - 1)
+
+        self.assertTrue(InvitationUser.reserve_invites(self.sample_user,
+                                                       remaining - 1))
+        self.assertFalse(InvitationUser.reserve_invites(self.sample_user))
+        self.assertTrue(objs.create_invitation(self.sample_user,
+                                               reserve=True) is None)
+
+    def test_generate_keys(self):
+        """
+        Test that keys are generated in batches from the configured alphabet
+        and length.
+
+        """
+        keys = utils.generate_keys(1000)
+        self.assertEqual(len(set(keys)), 1000)
+        self.assertTrue(all(len(key) == 32 and key.isalnum() for key in keys))
+        with self.settings(INVITATION_KEY_LENGTH=12,
+                           INVITATION_KEY_ALPHABET='ab'):
+            key = utils.generate_key()
+        self.assertEqual(len(key), 12)
+        self.assertEqual(set(key) - set('ab'), set())
+
+    def test_key_collision_retry(self):
+        """
+        Test that a generated key that is already taken is replaced, for
+        single and bulk creation.
+
+        """
+        taken = self.sample_key.key
+        with mock.patch('invitation.utils.generate_keys',
+                        side_effect=[[taken], ['fresh1']]):
+            key = InvitationKey.objects.create_invitation(self.sample_user)
+        self.assertEqual(key.key, 'fresh1')
+
+        with mock.patch('invitation.utils.generate_keys',
+                        side_effect=[['fresh2', taken], ['fresh3']]):
+            keys = InvitationKey.objects.create_invitations(
+                self.sample_user, [{}, {}])
+        self.assertEqual(sorted(key.key for key in keys),
+                         ['fresh2', 'fresh3'])
+        self.assertEqual(InvitationKey.objects.filter(key=taken).count(), 1)
+
+        with mock.patch('invitation.utils.generate_keys',
+                        return_value=[taken]):
+            self.assertRaises(IntegrityError,
+                              InvitationKey.objects.create_invitation,
+                              self.sample_user)
+
+    def test_group_user(self):
+        """
+        Test that ``group_user`` adds the registrant to the groups of the key
+        and the extra groups with a single insert, skipping unknown names.
+
+        """
+        staff = Group.objects.create(name='staff')
+        beta = Group.objects.create(name='beta')
+        key = InvitationKey.objects.create_invitation(
+            self.sample_user, {'recipient_email': 'bob@example.com',
+                               'groups': 'staff, missing'})
+        self.assertEqual(list(key.groups.all()), [staff])
+        bob = User.objects.create_user(username='bob',
+                                       email='bob@example.com')
+        group_cache.get_map()
+        with self.assertNumQueries(2):
+            key.group_user(bob, ['beta', 'missing'])
+        self.assertEqual(set(bob.groups.all()), set([staff, beta]))
+        # existing memberships are ignored
+        key.group_user(bob, ['beta'])
+        self.assertEqual(bob.groups.count(), 2)
+
+        # renaming a group invalidates the cached names
+        beta.name = 'gamma'
+        beta.save()
+        self.assertEqual(group_cache.get_ids(['beta', 'gamma']), [beta.pk])
+
+    @override_settings(INVITATION_BLACKLIST=('@mydomain.com',))
+    def test_import_invitations(self):
+        """
+        Test that ``manage.py import_invitations`` skips invalid, blacklisted
+        and already invited addresses, and resumes after the last chunk.
+
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'invites.csv')
+        Group.objects.create(name='staff')
+        Group.objects.create(name='beta')
+        with open(path, 'w') as f:
+            f.write('email,first_name,last_name,groups,uses\n'
+                    'bob@example.com,Bob,Smith,"staff,beta",2\n'
+                    'BOB@example.com,,,,\n'
+                    'not-an-email,,,,\n'
+                    'me@mydomain.com,,,,\n'
+                    'alice@example.com,,,,\n')
+
+        management.call_command('import_invitations', path,
+                                from_user='alice', chunk_size=2,
+                                verbosity=0)
+        bob = InvitationKey.objects.get(recipient_email='bob@example.com')
+        self.assertEqual(sorted(bob.groups.values_list('name', flat=True)),
+                         ['beta', 'staff'])
+        self.assertEqual(bob.uses_left, 2)
+        self.assertEqual(InvitationKey.objects.count(), 3)
+
+        with open(path, 'a') as f:
+            f.write('carol@example.com,Carol,,,\n'
+                    'bob@example.com,,,,\n')
+        out = StringIO()
+        management.call_command('import_invitations', path,
+                                from_user='alice', chunk_size=2, stdout=out)
+        self.assertIn("Resuming after 5 records", out.getvalue())
+        self.assertEqual(InvitationKey.objects.count(), 4)
+        self.assertTrue(InvitationKey.objects
+                        .filter(recipient_email='carol@example.com').exists())
+
+    def test_import_invitations_case_and_resend(self):
+        """
+        Test that ``manage.py import_invitations`` matches existing users and
+        keys case insensitively, and sends the keys of a chunk whose sending
+        was interrupted when resuming.
+
+        """
+        from invitation.management.commands import import_invitations
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'invites.csv')
+        InvitationKey.objects.create_invitation(
+            self.sample_user, {'recipient_email': 'bob@example.com'})
+        with open(path, 'w') as f:
+            f.write('email,first_name,last_name,groups,uses\n'
+                    'ALICE@example.com,,,,\n'
+                    'Bob@Example.com,,,,\n'
+                    'carol@example.com,,,,\n')
+
+        with mock.patch.object(import_invitations.Command, 'send',
+                               side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, management.call_command,
+                              'import_invitations', path, from_user='alice',
+                              send=True, verbosity=0)
+        self.assertEqual(len(mail.outbox), 0)
+        carol = InvitationKey.objects.get(recipient_email='carol@example.com')
+        self.assertEqual(InvitationKey.objects.filter(
+            recipient_email__iexact='bob@example.com').count(), 1)
+
+        management.call_command('import_invitations', path,
+                                from_user='alice', send=True, verbosity=0)
+        self.assertEqual([message.to for message in mail.outbox],
+                         [[carol.recipient_email]])
+        self.assertEqual(InvitationKey.objects.count(), 4)
+
 
 class InvitationFormTests(InvitationTestCase):
     """
@@ -290,6 +815,473 @@ class InvitationFormTests(InvitationTestCase):
         self.assertTrue(form.is_valid())
 
 
+class BulkInvitationViewTests(InvitationTestCase):
+    """
+    Tests for the staff only bulk invitation view.
+
+    """
+    def setUp(self):
+        super(BulkInvitationViewTests, self).setUp()
+        self.sample_user.is_staff = True
+        self.sample_user.save()
+        self.client.login(username='alice', password='secret')
+
+    @override_settings(
+        EMAIL_BACKEND='invitation.tests.FailingEmailBackend',
+        INVITATION_DELIVERY_BACKEND='invitation.backends.EmailDeliveryBackend')
+    def test_send_bulk_invitations(self):
+        """
+        Test that every address gets a key and an email, and that a failed
+        email doesn't stop the others from being sent.
+
+        """
+        to_emails = ('bob@example.com, Bob, Smith; carol@fail.example.com; '
+                     'dave@example.com; ; bob@example.com')
+        response = self.client.post(reverse('invitation_invite_bulk'),
+                                    data={'post': 'yes',
+                                          'to_emails': to_emails,
+                                          'sender_note': 'Join us',
+                                          'from_email': 'staff@example.com'})
+        self.assertRedirect(response, 'invitation_invite_bulk')
+
+        keys = InvitationKey.objects.exclude(
+            pk__in=[self.sample_key.pk, self.expired_key.pk])
+        self.assertEqual(keys.count(), 3)
+        bob = keys.get(recipient_email='bob@example.com')
+        self.assertEqual((bob.recipient_first_name, bob.recipient_last_name),
+                         ('Bob', 'Smith'))
+        self.assertTrue(bob.expires_at is not None)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['bob@example.com', 'dave@example.com'])
+        self.assertEqual(mail.outbox[0].from_email, 'staff@example.com')
+        invitation_user = InvitationUser.objects.get(inviter=self.sample_user)
+        self.assertEqual(invitation_user.invites_sent(), 5)
+
+
+class ClassLoadingTests(TestCase):
+    """
+    Tests for the memoized class loading of ``utils``.
+
+    """
+    def test_class_for_name(self):
+        """
+        Test that dotted paths are imported once and that bad paths raise
+        ``ImproperlyConfigured``.
+
+        """
+        self.assertTrue(utils.str_to_class('invitation.cache.DummyKeyCache')
+                        is DummyKeyCache)
+        with mock.patch('importlib.import_module') as import_module:
+            utils.str_to_class('invitation.cache.DummyKeyCache')
+        self.assertFalse(import_module.called)
+        self.assertRaises(ImproperlyConfigured, utils.str_to_class,
+                          'invitation.nomodule.Backend')
+        self.assertRaises(ImproperlyConfigured, utils.str_to_class,
+                          'invitation.cache.NoSuchCache')
+        with self.settings(INVITATION_DELIVERY_BACKEND='NoSuchBackend'):
+            self.assertRaises(ImproperlyConfigured,
+                              utils.check_configuration)
+        with self.settings(INVITATION_KEY_LENGTH=41):
+            self.assertRaises(ImproperlyConfigured,
+                              utils.check_configuration)
+        with self.settings(INVITATION_KEY_LENGTH=40):
+            utils.check_configuration()
+
+    def test_lazy_imports(self):
+        """
+        Test that the registration backend is resolved on first use and that
+        ``manage.py invitation_import_time`` reports the import times.
+
+        """
+        self.assertTrue(views.InvitationKeyForm is utils.get_invitation_form())
+        self.assertTrue(views.reg_backend is utils.get_registration_backend())
+        self.assertTrue(views.RegistrationForm is
+                        utils.get_registration_backend().get_registration_form())
+        # unknown names never resolve the registration backend
+        with mock.patch.object(utils, 'get_registration_backend',
+                               side_effect=ImproperlyConfigured):
+            self.assertRaises(AttributeError, getattr, views, 'no_such_name')
+            self.assertFalse(hasattr(views, '__wrapped__'))
+
+        out = StringIO()
+        management.call_command('invitation_import_time', 'invitation.urls',
+                                repeat=1, stdout=out)
+        self.assertTrue(out.getvalue().startswith('invitation.urls'))
+
+    def test_get_instance(self):
+        """
+        Test that stateless classes are instantiated once.
+
+        """
+        generator = utils.get_token_generator()
+        self.assertTrue(isinstance(generator, DefaultTokenGenerator))
+        self.assertTrue(utils.get_token_generator() is generator)
+        self.assertTrue(utils.get_delivery_queue() is None)
+        with self.settings(INVITATION_DELIVERY_QUEUE=
+                           'invitation.queue.DatabaseDeliveryQueue'):
+            self.assertTrue(utils.get_delivery_queue() is
+                            utils.get_delivery_queue())
+
+
+class ConcurrencyTests(TransactionTestCase):
+    """
+    Stress tests running several threads, each with its own database
+    connection, against the same rows.
+
+    """
+    threads = 8
+
+    @classmethod
+    def setUpClass(cls):
+        super(ConcurrencyTests, cls).setUpClass()
+        cls.memory_database = None
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # shared in-memory SQLite databases lock whole tables per
+            # connection, run on a file so the locking matches production
+            connection.ensure_connection()
+            cls.memory_database = (connection.settings_dict['NAME'],
+                                   connection.connection)
+            cls.tempdir = tempfile.mkdtemp()
+            connection.connection = None
+            connection.settings_dict['NAME'] = os.path.join(cls.tempdir,
+                                                            'test.sqlite3')
+            management.call_command('migrate', run_syncdb=True,
+                                    verbosity=0, interactive=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.memory_database is not None:
+            connection.close()
+            (connection.settings_dict['NAME'],
+             connection.connection) = cls.memory_database
+            shutil.rmtree(cls.tempdir)
+        super(ConcurrencyTests, cls).tearDownClass()
+
+    def run_threads(self, target, *args):
+        results = []
+        errors = []
+        start = threading.Barrier(self.threads)
+
+        def run():
+            try:
+                start.wait()
+                for attempt in range(50):
+                    try:
+                        results.append(target(*args))
+                        break
+                    except OperationalError:
+                        # SQLite reports "database is locked" to writers
+                        # that wait too long, other databases block instead
+                        time.sleep(0.01)
+                else:
+                    errors.append("gave up")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=run) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_concurrent_mark_used(self):
+        """
+        Test that concurrent signups with a multi-use key never use it more
+        often than allowed and don't lose accepted counts.
+
+        """
+        inviter = User.objects.create_user(username='alice',
+                                           password='secret')
+        registrant = User.objects.create_user(username='bob',
+                                              password='secret')
+        key = InvitationKey.objects.create_invitation(inviter)
+        key.uses_left = 3
+        key.save()
+
+        def mark_used():
+            return InvitationKey.objects.get(pk=key.pk).mark_used(registrant)
+
+        results = self.run_threads(mark_used)
+        self.assertEqual(sorted(results), [False] * 5 + [True] * 3)
+        key.refresh_from_db()
+        self.assertEqual(key.uses_left, 0)
+        self.assertEqual(
+            InvitationUser.objects.get(inviter=inviter).invites_accepted, 3)
+
+    def test_concurrent_reservations(self):
+        """
+        Test that parallel invitations never exceed the user's allocation.
+
+        """
+        inviter = User.objects.create_user(username='alice',
+                                           password='secret')
+        InvitationUser.objects.filter(inviter=inviter)\
+            .update(invites_allocated=3)
+
+        def invite():
+            return InvitationKey.objects.create_invitation(
+                inviter, {'recipient_email': 'bob@example.com'},
+                reserve=True)
+
+        results = []
+        for attempt in range(4):
+            results += self.run_threads(invite)
+        self.assertEqual(len([key for key in results if key is not None]), 3)
+        self.assertEqual(InvitationKey.objects.count(), 3)
+        self.assertEqual(
+            InvitationUser.objects.get(inviter=inviter).invites_sent(), 3)
+
+
+@skipUnless(connection.vendor == 'sqlite',
+            "Query plans are only checked on SQLite")
+class QueryPlanTests(InvitationTestCase):
+    """
+    Tests that the common ``InvitationKey`` lookups use an index.
+
+    """
+    def assertUsesIndex(self, queryset, index_name=None):
+        plan = queryset.explain()
+        self.assertTrue('USING INDEX' in plan or
+                        'USING COVERING INDEX' in plan, plan)
+        if index_name:
+            self.assertTrue(index_name in plan, plan)
+
+    def test_query_plans(self):
+        """
+        Test the plans of the lookups by key, by recipient, by sender and of
+        usable and expired keys.
+
+        """
+        objs = InvitationKey.objects
+        self.assertUsesIndex(objs.filter(key=self.sample_key.key))
+        self.assertUsesIndex(
+            objs.usable().filter(recipient_email__in=['bob@example.com']),
+            'invitation_recipient_idx')
+        self.assertUsesIndex(
+            objs.filter(from_user=self.sample_user).order_by('-date_invited'),
+            'invitation_sender_idx')
+        self.assertUsesIndex(objs.usable().order_by('expires_at'),
+                             'invitation_usable_idx')
+        self.assertUsesIndex(objs.expired())
+
+
+class SiteURLTests(InvitationTestCase):
+    """
+    Tests for the cached site URLs of ``utils.get_site_urls``.
+
+    """
+    def test_site_urls(self):
+        """
+        Test that the URLs are computed once per site and scheme, follow the
+        request scheme and are refreshed when the site is saved.
+
+        """
+        site = Site.objects.get_current()
+        urls = utils.get_site_urls()
+        self.assertEqual(urls['site'], site)
+        self.assertEqual(urls['root_url'], 'http://%s' % site.domain)
+        self.assertEqual(urls['static_url'], 'http://%s/static/' % site.domain)
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_site(), (site, urls['root_url']))
+
+        request = RequestFactory().get('/', secure=True)
+        self.assertEqual(utils.get_site_urls(request)['root_url'],
+                         'https://%s' % site.domain)
+        with self.settings(MEDIA_URL='https://media.example.com/'):
+            self.assertEqual(utils.get_site_urls()['media_url'],
+                             'https://media.example.com/')
+
+        site.domain = 'invites.example.com'
+        site.save()
+        self.assertEqual(utils.get_site()[1], 'http://invites.example.com')
+
+    def test_invitation_links_follow_request(self):
+        """
+        Test that invitations sent from the invite views, directly or through
+        the delivery queue, link to the scheme of the request.
+
+        """
+        root_url = 'https://%s/' % Site.objects.get_current().domain
+        InvitationUser.objects.filter(inviter=self.sample_user)\
+            .update(invites_allocated=5)
+        self.client.login(username='alice', password='secret')
+        self.client.post(reverse('invitation_invite'),
+                         data={'email': 'bob@example.com'}, secure=True)
+        with self.settings(INVITATION_DELIVERY_QUEUE=
+                           'invitation.queue.DatabaseDeliveryQueue'):
+            self.client.post(reverse('invitation_invite'),
+                             data={'email': 'carol@example.com'}, secure=True)
+            management.call_command('process_invitation_queue', verbosity=0)
+        self.assertEqual(len(mail.outbox), 2)
+        for message in mail.outbox:
+            self.assertIn(root_url + 'invited/', message.body)
+            self.assertNotIn('http://', message.alternatives[0][0])
+
+
+class TicketTests(InvitationTestCase):
+    """
+    Tests for the signed invitation tickets.
+
+    """
+    def get_request(self, session):
+        request = RequestFactory().get('/')
+        request.session = session
+        return request
+
+    def test_ticket(self):
+        """
+        Test that tickets round trip, expire with the key and are rejected
+        when tampered with.
+
+        """
+        request = self.get_request({})
+        tickets.issue_ticket(request, self.sample_key, 'bob@example.com')
+        with self.assertNumQueries(0):
+            ticket = tickets.get_ticket(request)
+        self.assertEqual(ticket.key, self.sample_key.key)
+        self.assertEqual(ticket.recipient, 'bob@example.com')
+        self.assertTrue(ticket.is_valid())
+
+        value = tickets.make_ticket(self.expired_key)
+        ticket = tickets.load_ticket(value)
+        self.assertFalse(ticket.is_valid())
+        self.assertTrue(ticket.get_context()['expired_key'])
+        self.assertIsNone(tickets.load_ticket(value[:-1] + 'x'))
+
+        tickets.clear_ticket(request)
+        self.assertIsNone(tickets.get_ticket(request))
+
+    def test_legacy_session(self):
+        """
+        Test that sessions holding the key itself are converted to a ticket.
+
+        """
+        request = self.get_request({'invitation_key': self.sample_key.key,
+                                    'invitation_recipient': 'x',
+                                    'invitation_context': {}})
+        ticket = tickets.get_ticket(request)
+        self.assertEqual(ticket.key, self.sample_key.key)
+        self.assertEqual(list(request.session), [tickets.SESSION_KEY])
+
+        request = self.get_request({'invitation_key': self.expired_key.key})
+        self.assertIsNone(tickets.get_ticket(request))
+        self.assertEqual(request.session, {})
+
+
+class TokenTests(InvitationTestCase):
+    """
+    Tests for the token images of ``DefaultTokenGenerator``.
+
+    """
+    def setUp(self):
+        super(TokenTests, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        media = self.settings(MEDIA_ROOT=tmp_dir)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.generator = DefaultTokenGenerator()
+        tokens.token_cache.clear()
+        self.factory = RequestFactory()
+
+    def test_render_token(self):
+        """
+        Test that tokens are rendered in memory from the cached base image.
+
+        """
+        png = tokens.render_token('01/01/20', ('Bob', 'Smith'))
+        self.assertTrue(png.startswith(b'\x89PNG'))
+        base = tokens.load_static_image(tokens.TOKEN_INVITE_IMAGE)
+        base.putpixel((0, 0), (1, 2, 3, 4))
+        self.assertNotEqual(tokens.load_static_image(
+            tokens.TOKEN_INVITE_IMAGE).getpixel((0, 0)), (1, 2, 3, 4))
+        self.assertTrue(tokens.text_layer('Bob') is tokens.text_layer('Bob'))
+
+    def test_render_tokens(self):
+        """
+        Test that tokens rendered across a process pool match the ones
+        rendered in process and are saved to the storage.
+
+        """
+        other_key = InvitationKey.objects.create_invitation(
+            self.sample_user, {'recipient_email': 'bob@example.com',
+                               'recipient_first_name': 'Bob',
+                               'recipient_last_name': 'Smith'})
+        instances = [self.sample_key, other_key]
+        self.assertEqual(self.generator.render_tokens(instances,
+                                                      max_workers=2), 2)
+        for instance in instances:
+            with default_storage.open('tokens/%s.png' % instance.key) as f:
+                self.assertEqual(f.read(),
+                                 self.generator.render_token(instance))
+        # tokens already in the storage are skipped
+        self.assertEqual(self.generator.render_tokens(instances), 0)
+
+    def test_token_cache(self):
+        """
+        Test that the token cache evicts the least recently used tokens once
+        it's full.
+
+        """
+        token_cache = tokens.TokenCache(max_size=10)
+        token_cache.set('a', b'1234')
+        token_cache.set('b', b'1234')
+        token_cache.get('a')
+        token_cache.set('c', b'1234')
+        self.assertTrue(token_cache.get('b') is None)
+        self.assertEqual(token_cache.get('a')[0], b'1234')
+        token_cache.set('d', b'12345678901')
+        self.assertTrue(token_cache.get('d') is None)
+        token_cache.evict('a')
+        self.assertEqual(len(token_cache), 1)
+
+    def test_token_view(self):
+        """
+        Test that tokens are only rendered when the token view is first hit,
+        that conditional requests get a 304 and that the invalid token is
+        served for unknown keys.
+
+        """
+        with mock.patch('invitation.utils.reverse', return_value='/token/'):
+            html = self.generator.generate_token(self.sample_key,
+                                                 'http://testserver/invited/')
+        self.assertTrue('<img' in html)
+        token_path = 'tokens/%s.png' % self.sample_key.key
+        self.assertFalse(default_storage.exists(token_path))
+
+        request = self.factory.get('/token/')
+        with mock.patch.object(self.generator, 'render_token',
+                               wraps=self.generator.render_token) as render:
+            response = self.generator.token_view(request, self.sample_key.key)
+            self.generator.token_view(request, self.sample_key.key)
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(default_storage.exists(token_path))
+        with default_storage.open(token_path) as f:
+            self.assertEqual(response.content, f.read())
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        request = self.factory.get('/token/',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        response = self.generator.token_view(request, self.sample_key.key)
+        self.assertEqual(response.status_code, 304)
+
+        self.generator.handle_invitation_used(self.sample_key)
+        self.assertTrue(tokens.token_cache.get(self.sample_key.key) is None)
+        self.assertFalse(default_storage.exists(token_path))
+
+        response = self.generator.token_view(self.factory.get('/token/'),
+                                             self.expired_key.key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, tokens.read_static_file(
+            tokens.TOKEN_INVALID_IMAGE))
+
+
 class InvitationViewTestsRegistration(InvitationTestCaseRegistration):
     """
     Tests for the views included in django-invitation when django-registration
@@ -335,6 +1327,36 @@ class InvitationViewTestsRegistration(InvitationTestCaseRegistration):
         self.assertEqual(response.context['remaining_invitations'], 0)
         self.assertTrue(response.context['form'] is not None)
 
+    def test_preview_cache(self):
+        """
+        Test that the email previews are rendered once and reused until the
+        language changes.
+
+        """
+        self.client.login(username='alice', password='secret')
+        create_invitation = InvitationKey.objects.create_invitation
+        with mock.patch.object(InvitationKey.objects, 'create_invitation',
+                               wraps=create_invitation) as create:
+            response = self.client.get(reverse('invitation_invite'))
+            self.assertEqual(response.status_code, 200)
+            preview = response.context['email_preview']
+            self.assertTrue('--your note will be inserted here--' in preview)
+            self.assertEqual(create.call_count, 1)
+
+            response = self.client.get(reverse('invitation_invite'))
+            self.assertEqual(response.context['email_preview'], preview)
+            self.assertEqual(create.call_count, 1)
+
+            with translation.override('fr'):
+                views.render_previews(self.sample_user,
+                                      ('invitation/invitation_email.html',))
+            self.assertEqual(create.call_count, 2)
+
+            with self.settings(INVITATION_PREVIEW_CACHE_TIMEOUT=0):
+                self.client.get(reverse('invitation_invite'))
+                self.client.get(reverse('invitation_invite'))
+            self.assertEqual(create.call_count, 4)
+
     def test_invited_view(self):
         """
         Test that the invited view invite the user from a valid
@@ -400,6 +1422,25 @@ class InvitationViewTestsRegistration(InvitationTestCaseRegistration):
         except User.DoesNotExist:
             pass
 
+    def test_post_registration_redirect_key_used(self):
+        """
+        Test that a registration losing the race for the last use of a key
+        is disabled instead of let in.
+
+        """
+        self.sample_key.mark_used(self.sample_user)
+        user = User.objects.create_user(username='new_user',
+                                        password='secret')
+        request = RequestFactory().post('/', {
+            'invitation_key': self.sample_key.key})
+        request.REQUEST = request.POST
+        request.session = {}
+        self.assertEqual(
+            InvitationMixin().post_registration_redirect(request, user),
+            ('registration_disallowed', (), {}))
+        user.refresh_from_db()
+        self.assertFalse(user.is_active)
+
 
 class InvitationViewTestsAllauth(InvitationTestCaseAllauth):
     """
@@ -479,6 +1520,81 @@ class InvitationViewTestsAllauth(InvitationTestCaseAllauth):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, wrong_key_template)
 
+    def test_ticket_key_duration(self):
+        """
+        Test that tickets and signed links expire with the key, for keys
+        that never expire and keys with a custom duration.
+
+        """
+        if not allauth_installed:
+            print ("** Skipping test requiring django-allauth **")
+            return
+        from invitation.accountadapter import InvitationAccountAdapter
+
+        objs = InvitationKey.objects
+        keys = []
+        for duration, days_ago, valid in ((-1, 30, True), (60, 30, True),
+                                          (1, 2, False)):
+            key = objs.create_invitation(user=self.sample_user)
+            key.duration = duration
+            key.date_invited -= datetime.timedelta(days=days_ago)
+            key.save()
+            keys.append((key, valid))
+
+        wrong_key_template = 'invitation/wrong_invitation_key.html'
+        for key, valid in keys:
+            ticket = tickets.load_ticket(tickets.make_ticket(key))
+            self.assertEqual(ticket.is_valid(), valid)
+
+            response = self.client.get(reverse('invitation_invited',
+                                               kwargs={'invitation_key': key.key}))
+            if valid:
+                self.assertTemplateUsed(response, 'invitation/invited.html')
+                request = RequestFactory().get('/')
+                request.session = self.client.session
+                self.assertTrue(InvitationAccountAdapter(request)
+                                .is_open_for_signup(request))
+            else:
+                self.assertTemplateUsed(response, wrong_key_template)
+
+            with self.settings(INVITATION_SIGNED_LINKS=True):
+                response = self.client.get(key.get_invitation_path())
+            self.assertTemplateUsed(response, 'invitation/invited.html'
+                                    if valid else wrong_key_template)
+
+    @override_settings(INVITATION_SIGNED_LINKS=True)
+    def test_signed_links(self):
+        """
+        Test that signed invitation links are accepted, and that forged or
+        expired links are rejected without querying the database.
+
+        """
+        path = self.sample_key.get_invitation_path()
+        self.assertIn('/invited/s/', path)
+        self.assertTrue(self.sample_key.get_context()['invitation_url']
+                        .endswith(path))
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'invitation/invited.html')
+        self.assertEqual(response.context['invitation_key'],
+                         self.sample_key.key)
+        self.assertEqual(self.client.session[tickets.SESSION_KEY],
+                         path.split('/')[-2])
+
+        wrong_key_template = 'invitation/wrong_invitation_key.html'
+        forged = path[:-2] + ('A' if path[-2] != 'A' else 'B') + '/'
+        with self.assertNumQueries(0):
+            response = self.client.get(forged)
+        self.assertTemplateUsed(response, wrong_key_template)
+        self.assertTrue(response.context['invalid_key'])
+
+        expired = reverse('invitation_invited_signed', kwargs={
+            'ticket': tickets.make_ticket(self.expired_key)})
+        with self.assertNumQueries(0):
+            response = self.client.get(expired)
+        self.assertTemplateUsed(response, wrong_key_template)
+        self.assertTrue(response.context['expired_key'])
+
     @override_settings(ACCOUNT_ADAPTER='invitation.accountadapter.InvitationAccountAdapter')
     def test_register_view(self):
         """
@@ -500,15 +1616,27 @@ class InvitationViewTestsAllauth(InvitationTestCaseAllauth):
         self.assertTemplateUsed(response,
                                 'invitation/invited.html')
 
-        # If the key gets approved it should be stored in the session
-        self.assertIn('invitation_key', self.client.session)
+        # If the key gets approved a ticket should be stored in the session
+        self.assertIn(tickets.SESSION_KEY, self.client.session)
+        ticket = tickets.load_ticket(self.client.session[tickets.SESSION_KEY])
+        self.assertEqual(ticket.key, self.sample_key.key)
+        self.assertTrue(ticket.is_valid())
+
+        # The adapter checks the ticket without querying the database
+        from invitation.accountadapter import InvitationAccountAdapter
+        request = RequestFactory().get('/')
+        request.session = self.client.session
+        request.session.keys()  # load the session up front
+        with self.assertNumQueries(0):
+            self.assertTrue(InvitationAccountAdapter(request)
+                            .is_open_for_signup(request))
 
         response = self.client.post(reverse('account_signup'),
                                     data=registration_data)
         self.assertEqual(response.status_code, 302)
 
-        # Check that the key has been removed from the session data
-        self.assertNotIn('invitation_key', self.client.session)
+        # Check that the ticket has been removed from the session data
+        self.assertNotIn(tickets.SESSION_KEY, self.client.session)
 
         # self.assertRedirect(response, 'registration_complete')
         user = User.objects.get(username='new_user')
@@ -523,6 +1651,97 @@ class InvitationViewTestsAllauth(InvitationTestCaseAllauth):
         self.assertTemplateUsed(response,
                                 'invitation/wrong_invitation_key.html')
 
+    def signup(self, client, username):
+        data = dict(self.sample_allauth_data, username=username,
+                    email='%s@example.com' % username)
+        return client.post(reverse('account_signup'), data=data)
+
+    @override_settings(ACCOUNT_ADAPTER='invitation.accountadapter.InvitationAccountAdapter')
+    def test_used_up_key(self):
+        """
+        Test that signups are refused once the key is used up, even by
+        visitors that were invited before.
+
+        """
+        if not allauth_installed:
+            print ("** Skipping test requiring django-allauth **")
+            return
+
+        url = reverse('invitation_invited',
+                      kwargs={'invitation_key': self.sample_key.key})
+        clients = [Client(), Client()]
+        for client in clients:
+            response = client.get(url)
+            self.assertTemplateUsed(response, 'invitation/invited.html')
+
+        response = self.signup(clients[0], 'first_user')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(User.objects.get(username='first_user').is_active)
+
+        response = self.signup(clients[1], 'second_user')
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response,
+                                'invitation/wrong_invitation_key.html')
+        self.assertTrue(response.context['no_uses_left_key'])
+        self.assertFalse(User.objects.filter(username='second_user').exists())
+
+    @override_settings(ACCOUNT_ADAPTER='invitation.accountadapter.InvitationAccountAdapter',
+                       INVITATION_SIGNED_LINKS=True)
+    def test_signed_link_reuse(self):
+        """
+        Test that a signed link can't sign up more users than its key allows,
+        nor any once the key is deleted.
+
+        """
+        if not allauth_installed:
+            print ("** Skipping test requiring django-allauth **")
+            return
+
+        path = self.sample_key.get_invitation_path()
+        clients = [Client() for i in range(3)]
+        for client in clients:
+            response = client.get(path)
+            self.assertTemplateUsed(response, 'invitation/invited.html')
+        responses = [self.signup(client, 'user%d' % i)
+                     for i, client in enumerate(clients)]
+        self.assertEqual([response.status_code for response in responses],
+                         [302, 200, 200])
+        self.assertEqual(User.objects.filter(username__startswith='user')
+                         .count(), 1)
+        self.assertEqual(InvitationKey.objects.get(pk=self.sample_key.pk)
+                         .uses_left, 0)
+
+        key = InvitationKey.objects.create_invitation(user=self.sample_user)
+        self.client.get(key.get_invitation_path())
+        key.delete()
+        response = self.signup(self.client, 'deleted_key_user')
+        self.assertTemplateUsed(response,
+                                'invitation/wrong_invitation_key.html')
+        self.assertTrue(response.context['invalid_key'])
+        self.assertFalse(User.objects.filter(username='deleted_key_user')
+                         .exists())
+
+    @override_settings(ACCOUNT_ADAPTER='invitation.accountadapter.InvitationAccountAdapter')
+    def test_used_up_key_race(self):
+        """
+        Test that an account is disabled when another signup takes the last
+        use of the key between the check and ``mark_used``.
+
+        """
+        if not allauth_installed:
+            print ("** Skipping test requiring django-allauth **")
+            return
+
+        self.client.get(reverse('invitation_invited',
+                                kwargs={'invitation_key': self.sample_key.key}))
+        InvitationKey.objects.filter(pk=self.sample_key.pk).update(uses_left=0)
+        with mock.patch.object(InvitationKey.objects, 'is_key_valid',
+                               return_value=self.sample_key):
+            self.signup(self.client, 'late_user')
+        user = User.objects.get(username='late_user')
+        self.assertFalse(user.is_active)
+        self.assertFalse(user.invitations_used.exists())
+
 
 class InviteModeOffTestsRegistration(InvitationTestCaseRegistration):
     """
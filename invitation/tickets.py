@@ -0,0 +1,103 @@
+"""
+Signed invitation tickets.
+
+When the ``invited`` view accepts a key it stores a ticket in the session
+instead of the key, the recipient and the whole template context.  The ticket
+is a short signed string holding the key, the recipient and the expiry date
+of the key, so the allauth adapters can check it without querying the
+database; the key itself is only checked again when the signup is submitted.
+
+With ``INVITATION_SIGNED_LINKS`` the invitation links carry the ticket too,
+so the ``invited_signed`` view rejects forged and expired links without a
+query.
+"""
+from collections import namedtuple
+import time
+
+from django.core import signing
+
+import logging
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = 'invitation_ticket'
+SALT = 'invitation.tickets'
+
+# session keys used before tickets
+LEGACY_SESSION_KEYS = ('invitation_key', 'invitation_recipient',
+                       'invitation_context')
+
+
+class Ticket(namedtuple('Ticket', 'key recipient expires')):
+
+    def is_valid(self):
+        # keys that never expire have no expiry date
+        return self.expires is None or time.time() < self.expires
+
+    def get_context(self):
+        """
+        Return the context for the wrong invitation key template.
+        """
+        context = {'invitation_key': self.key,
+                   'invitation_recipient': self.recipient}
+        if not self.is_valid():
+            context['expired_key'] = True
+        return context
+
+
+def make_ticket(key, recipient=''):
+    """
+    Return the signed ticket for the ``InvitationKey`` ``key``.
+    """
+    expires = key.get_expiry_datetime()
+    if expires is not None:
+        expires = int(expires.timestamp())
+    return signing.dumps([key.key, recipient or '', expires], salt=SALT,
+                         compress=True)
+
+
+def load_ticket(value):
+    """
+    Return the ``Ticket`` signed in ``value``, or None if the signature
+    doesn't match.
+    """
+    try:
+        return Ticket(*signing.loads(value, salt=SALT))
+    except (signing.BadSignature, TypeError, ValueError):
+        logger.warning("Invalid invitation ticket")
+        return None
+
+
+def set_ticket(request, value):
+    request.session[SESSION_KEY] = value
+    for name in LEGACY_SESSION_KEYS:
+        request.session.pop(name, None)
+
+
+def issue_ticket(request, key, recipient=''):
+    set_ticket(request, make_ticket(key, recipient))
+
+
+def get_ticket(request):
+    """
+    Return the ``Ticket`` in the session of ``request``, or None.  Sessions
+    from before tickets are converted once.
+    """
+    value = request.session.get(SESSION_KEY)
+    if value is None and 'invitation_key' in request.session:
+        from invitation.models import InvitationKey
+
+        key = InvitationKey.objects.is_key_valid(
+            request.session['invitation_key'])
+        if not key:
+            clear_ticket(request)
+            return None
+        issue_ticket(request, key, key.recipient())
+        value = request.session[SESSION_KEY]
+    if value is None:
+        return None
+    return load_ticket(value)
+
+
+def clear_ticket(request):
+    for name in (SESSION_KEY,) + LEGACY_SESSION_KEYS:
+        request.session.pop(name, None)
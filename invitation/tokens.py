@@ -0,0 +1,222 @@
+"""
+Image helpers for ``DefaultTokenGenerator``.
+
+The base images are read once from the staticfiles storage and kept decoded in
+memory, the font and the stamped text layers are reused, and token images are
+encoded straight into memory buffers.  Rendered tokens are kept in a size
+bounded LRU cache, ``token_cache``.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from hashlib import md5
+from io import BytesIO
+import os
+import threading
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+TOKEN_INVITE_IMAGE = 'notification/img/token-invite.png'
+TOKEN_INVALID_IMAGE = 'notification/img/token-invalid.png'
+TEXT_COLOR = '#888'
+
+_static_files = {}
+_images = {}
+_lock = threading.Lock()
+
+
+def read_static_file(path):
+    """
+    Return the contents of the static file ``path``, read only once per
+    process.  Falls back to the staticfiles finders when the files haven't
+    been collected (e.g. during development).
+    """
+    contents = _static_files.get(path)
+    if contents is None:
+        try:
+            with staticfiles_storage.open(path) as f:
+                contents = f.read()
+        except (IOError, OSError, ImproperlyConfigured):
+            found = finders.find(path)
+            if not found:
+                raise
+            with open(found, 'rb') as f:
+                contents = f.read()
+        with _lock:
+            _static_files[path] = contents
+    return contents
+
+
+def static_file_etag(path):
+    return '"%s"' % md5(read_static_file(path)).hexdigest()
+
+
+def load_static_image(path):
+    """
+    Return a copy of the decoded static image ``path``.
+    """
+    from PIL import Image
+
+    image = _images.get(path)
+    if image is None:
+        image = Image.open(BytesIO(read_static_file(path))).convert('RGBA')
+        with _lock:
+            _images[path] = image
+    return image.copy()
+
+
+@lru_cache(maxsize=None)
+def get_font():
+    from PIL import ImageFont
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=512)
+def text_layer(text):
+    from PIL import Image, ImageDraw
+
+    font = get_font()
+    if hasattr(font, 'getbbox'):
+        left, top, right, bottom = font.getbbox(text)
+        size = (right, bottom)
+    else:
+        size = font.getsize(text)
+    layer = Image.new('RGBA', size)
+    ImageDraw.Draw(layer).text((0, 0), text, font=font, fill=TEXT_COLOR)
+    return layer
+
+
+def stamp(image, text, offset):
+    """
+    Paste ``text`` centered on ``image``, ``offset`` pixels below the middle,
+    and return the offset for the next line.
+    """
+    layer = text_layer(text)
+    iw, ih = image.size
+    tw, th = layer.size
+    x = iw // 2 - tw // 2
+    y = ih // 2 - th // 2
+    image.paste(layer, (x, y + offset), layer)
+    return offset + th
+
+
+def render_token(expiration_text, names=(), base_image=TOKEN_INVITE_IMAGE):
+    """
+    Stamp the expiration date and the recipient ``names`` on the base image
+    and return the PNG data.
+    """
+    image = load_static_image(base_image)
+    stamp(image, expiration_text, 18)
+    offset = -16
+    for name in names:
+        if name:
+            offset = stamp(image, name, offset)
+    buf = BytesIO()
+    image.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+
+def _init_worker(base_images):
+    # workers get the base images up front so they never touch the storage
+    _static_files.update(base_images)
+
+
+def _render_job(job):
+    return render_token(*job)
+
+
+def render_tokens(jobs, max_workers=None, base_image=TOKEN_INVITE_IMAGE):
+    """
+    Render the tokens for ``jobs``, a list of ``(expiration_text, names)``
+    tuples, across a pool of ``max_workers`` processes (by default
+    ``INVITATION_TOKEN_RENDER_WORKERS``, or the number of CPUs) and return
+    the PNG data in the same order.
+    """
+    jobs = [(expiration_text, tuple(names), base_image)
+            for expiration_text, names in jobs]
+    if max_workers is None:
+        max_workers = getattr(settings, 'INVITATION_TOKEN_RENDER_WORKERS',
+                              None) or os.cpu_count() or 1
+    max_workers = min(max_workers, len(jobs))
+    if max_workers <= 1:
+        return [_render_job(job) for job in jobs]
+    base_images = {base_image: read_static_file(base_image)}
+    chunksize = max(1, len(jobs) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                             initargs=(base_images,)) as executor:
+        return list(executor.map(_render_job, jobs, chunksize=chunksize))
+
+
+class TokenCache():
+    """
+    Least recently used cache of rendered token images, holding at most
+    ``INVITATION_TOKEN_CACHE_SIZE`` bytes of PNG data.  Entries are
+    ``(png, etag)`` tuples keyed by invitation key.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return getattr(settings, 'INVITATION_TOKEN_CACHE_SIZE', 4 * 1024 * 1024)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, png):
+        entry = (png, '"%s"' % md5(png).hexdigest())
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            if len(png) > self.max_size:
+                return entry
+            self._entries[key] = entry
+            self._size += len(png)
+            while self._size > self.max_size:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+        return entry
+
+    def evict(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+token_cache = TokenCache()
+
+
+def clear_caches(**kwargs):
+    if kwargs.get('setting') in (None, 'STATICFILES_STORAGE', 'STATIC_ROOT',
+                                 'STATICFILES_DIRS'):
+        with _lock:
+            _static_files.clear()
+            _images.clear()
+        token_cache.clear()
+
+
+setting_changed.connect(clear_caches)
@@ -2,12 +2,8 @@ from django.conf import settings
 from django.conf.urls import url
 from django.views.generic import TemplateView
 
-from invitation import utils
-from invitation.views import (invite, invited, register, send_bulk_invitations,
-                              token)
-
-reg_backend_class = utils.get_registration_backend_class()
-reg_backend = reg_backend_class().get_backend()
+from invitation.views import (invite, invited, invited_signed, register,
+                              send_bulk_invitations, token)
 
 urlpatterns = [
     url(r'^invite/complete/$', TemplateView.as_view(template_name='invitation/invitation_complete.html'), name='invitation_complete'),
@@ -16,8 +12,9 @@ urlpatterns = [
 
     # TODO: allow custom key regex since can have custom key  generator
     url(r'^invited/(?P<invitation_key>\w+)&(?P<invitation_recipient>\S+@\S+)?/$', invited, name='invitation_invited'),
+    url(r'^invited/s/(?P<ticket>[\w.:-]+)/$', invited_signed, name='invitation_invited_signed'),
     url(r'^invited/.*', invited),
-    url(r'^register/$', register, {'backend': reg_backend}, name='registration_register'),
+    url(r'^register/$', register, name='registration_register'),
 ]
 
 if getattr(settings, 'INVITATION_USE_TOKEN', False):
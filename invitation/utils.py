@@ -1,25 +1,94 @@
+import calendar
 import datetime
 from hashlib import sha1 as sha_constructor
 import importlib
 import random
+import re
+import secrets
+import string
+import threading
+from urllib.parse import urljoin, urlsplit
 
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.contrib.sites.requests import RequestSite
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import default_storage
+from django.core.signals import setting_changed
+from django.db import models
 from django.urls import reverse
 
 
-def get_site(request=None):
-    site = None
-    root_url = 'http://localhost'
+_site_urls = {}
+
+
+def get_url_scheme(request=None):
+    if request is not None:
+        return request.scheme
+    return getattr(settings, 'INVITATION_URL_SCHEME', 'http')
+
+
+def get_site_urls(request=None):
+    """
+    Return a dict with the current ``site`` and its ``root_url``,
+    ``static_url`` and ``media_url``.
+
+    The URLs are computed once per site and scheme.  With a ``request`` the
+    scheme is the request's and, without ``settings.SITE_ID``, the site is
+    looked up by host (Django caches that lookup too), so multi-tenant
+    deployments get their own URLs without a query per call.
+    """
+    scheme = get_url_scheme(request)
     if Site._meta.installed:
-        site = Site.objects.get_current()
-        root_url = 'http://%s' % site.domain
+        site = Site.objects.get_current(request)
+        cache_key = (site.pk, scheme)
+    elif request is not None:
+        site = RequestSite(request)
+        cache_key = (site.domain, scheme)
     else:
-        if request:
-            site = RequestSite(request)
-    return site, root_url
+        site = None
+        cache_key = (None, scheme)
+    urls = _site_urls.get(cache_key)
+    if urls is None:
+        domain = site.domain if site is not None else 'localhost'
+        root_url = '%s://%s' % (scheme, domain)
+        urls = _site_urls[cache_key] = {
+            'root_url': root_url,
+            'static_url': urljoin(root_url + '/', settings.STATIC_URL or ''),
+            'media_url': urljoin(root_url + '/', settings.MEDIA_URL or ''),
+        }
+    return dict(urls, site=site)
+
+
+def get_site(request=None):
+    urls = get_site_urls(request)
+    return urls['site'], urls['root_url']
+
+
+def clear_site_urls(sender=None, **kwargs):
+    if sender is Site:
+        for key in list(_site_urls):
+            if key[0] == kwargs['instance'].pk:
+                _site_urls.pop(key, None)
+    elif kwargs.get('setting') in ('SITE_ID', 'STATIC_URL', 'MEDIA_URL',
+                                   'INVITATION_URL_SCHEME'):
+        _site_urls.clear()
+
+
+models.signals.post_save.connect(clear_site_urls, sender=Site)
+models.signals.post_delete.connect(clear_site_urls, sender=Site)
+setting_changed.connect(clear_site_urls)
+
+
+def is_blacklisted(email):
+    """
+    Return whether ``email`` matches one of the regular expressions of
+    ``settings.INVITATION_BLACKLIST``.
+    """
+    for email_match in getattr(settings, 'INVITATION_BLACKLIST', ()):
+        if re.search(email_match, email) is not None:
+            return True
+    return False
 
 
 def get_registration_backend_class(backend_str=None):
@@ -32,6 +101,14 @@ def get_delivery_backend_class(delivery_str=None):
                         'invitation.backends.EmailDeliveryBackend')
 
 
+def get_delivery_queue_class(queue_str=None):
+    queue_str = queue_str or getattr(settings, 'INVITATION_DELIVERY_QUEUE',
+                                     None)
+    if not queue_str:
+        return None
+    return str_to_class(queue_str)
+
+
 def get_invitation_form(form_str=None):
     return str_to_class(form_str, 'INVITATION_FORM',
                         'invitation.forms.DefaultInvitationKeyForm')
@@ -42,22 +119,116 @@ def get_token_generator_class(generator_str=None):
                         'invitation.utils.DefaultTokenGenerator')
 
 
+def get_key_cache_class(cache_str=None):
+    return str_to_class(cache_str, 'INVITATION_KEY_CACHE',
+                        'invitation.cache.KeyValidationCache')
+
+
 def str_to_class(class_str, settings_key="", default_str=""):
     class_str = class_str or getattr(settings, settings_key, default_str)
+    if not class_str:
+        raise ImproperlyConfigured("%s is not set" % settings_key)
     mod, _, kls = class_str.rpartition('.')
     return class_for_name(mod, kls)
 
 
+_classes = {}
+_instances = {}
+_instances_lock = threading.Lock()
+
+
 def class_for_name(module_name, class_name):
+    """
+    Return ``class_name`` from ``module_name``.  Each dotted path is imported
+    only once per process; a path that can't be imported raises
+    ``ImproperlyConfigured``.
+    """
+    try:
+        return _classes[module_name, class_name]
+    except KeyError:
+        pass
     try:
         m = importlib.import_module(module_name)
+    except (ImportError, ValueError) as e:
+        raise ImproperlyConfigured('Error importing "%s.%s": %s' %
+                                   (module_name, class_name, e))
+    try:
         c = getattr(m, class_name)
-        return c
-    except:
+    except AttributeError:
+        raise ImproperlyConfigured('Module "%s" does not define "%s"' %
+                                   (module_name, class_name))
+    _classes[module_name, class_name] = c
+    return c
+
+
+def get_instance(class_str, settings_key="", default_str=""):
+    """
+    Return a shared instance of the class ``class_str`` (or the one named by
+    ``settings_key``).  Only for classes without per-use state, like token
+    generators, key caches and delivery queues.
+    """
+    class_str = class_str or getattr(settings, settings_key, default_str)
+    try:
+        return _instances[class_str]
+    except KeyError:
+        pass
+    with _instances_lock:
+        if class_str not in _instances:
+            _instances[class_str] = str_to_class(class_str, settings_key)()
+        return _instances[class_str]
+
+
+def get_registration_backend(backend_str=None):
+    return get_instance(backend_str, 'INVITATION_BACKEND',
+                        'invitation.backends.AllAuthRegistrationBackend')
+
+
+def get_token_generator(generator_str=None):
+    return get_instance(generator_str, 'INVITATION_TOKEN_GENERATOR',
+                        'invitation.utils.DefaultTokenGenerator')
+
+
+def get_key_cache(cache_str=None):
+    return get_instance(cache_str, 'INVITATION_KEY_CACHE',
+                        'invitation.cache.KeyValidationCache')
+
+
+def get_delivery_queue(queue_str=None):
+    """
+    Return the delivery queue, or None when invitations are sent right away.
+    """
+    queue_str = queue_str or getattr(settings, 'INVITATION_DELIVERY_QUEUE',
+                                     None)
+    if not queue_str:
         return None
+    return get_instance(queue_str)
+
+
+def check_configuration():
+    """
+    Resolve every configured class so that a wrong setting fails at startup
+    rather than on the first request that needs it.
+    """
+    get_registration_backend_class()
+    get_delivery_backend_class()
+    get_delivery_queue_class()
+    get_invitation_form()
+    get_key_cache_class()
+    if getattr(settings, 'INVITATION_USE_TOKEN', False):
+        get_token_generator_class()
+    from invitation.models import InvitationKey
+    max_length = InvitationKey._meta.get_field('key').max_length
+    key_length = getattr(settings, 'INVITATION_KEY_LENGTH', 32)
+    if not 0 < key_length <= max_length:
+        raise ImproperlyConfigured("INVITATION_KEY_LENGTH must be between 1 "
+                                   "and %d" % max_length)
 
 
 def get_invitation_key(user):
+    """
+    The SHA1 based key generator of earlier versions, kept for projects
+    that set it as ``INVITATION_KEY_GENERATOR``.
+    """
     salt = sha_constructor(str(random.random()).encode()).hexdigest()[:5]
     nowish = datetime.datetime.now()
     user_str = user.get_username()
@@ -66,6 +237,57 @@ def get_invitation_key(user):
     return key
 
 
+KEY_ALPHABET = string.ascii_letters + string.digits
+
+
+def generate_keys(count, length=None, alphabet=None):
+    """
+    Return ``count`` distinct random keys of ``length`` characters (default
+    ``INVITATION_KEY_LENGTH``, 32) drawn from ``alphabet`` (default
+    ``INVITATION_KEY_ALPHABET``, ASCII letters and digits).
+
+    The random bytes for the whole batch come from ``secrets`` in one call;
+    bytes that would bias the choice of characters are discarded.
+    """
+    length = length or getattr(settings, 'INVITATION_KEY_LENGTH', 32)
+    alphabet = alphabet or getattr(settings, 'INVITATION_KEY_ALPHABET',
+                                   KEY_ALPHABET)
+    if not 1 < len(alphabet) <= 256:
+        raise ImproperlyConfigured("The key alphabet needs 2 to 256 "
+                                   "characters")
+    limit = 256 - 256 % len(alphabet)
+    keys = set()
+    chars = []
+    while len(keys) < count:
+        missing = (count - len(keys)) * length - len(chars)
+        if missing > 0:
+            chars.extend(alphabet[b % len(alphabet)]
+                         for b in secrets.token_bytes(missing + missing // 4)
+                         if b < limit)
+        while len(chars) >= length and len(keys) < count:
+            keys.add(''.join(chars[-length:]))
+            del chars[-length:]
+    return list(keys)
+
+
+def generate_key(user=None):
+    """
+    The default ``INVITATION_KEY_GENERATOR``, see ``generate_keys``.
+    """
+    return generate_keys(1)[0]
+
+
+def get_invitation_keys(user, count):
+    """
+    Return ``count`` new keys for invitations from ``user``, in one batch
+    unless a custom ``INVITATION_KEY_GENERATOR`` is set.
+    """
+    key_generator = getattr(settings, 'INVITATION_KEY_GENERATOR', None)
+    if key_generator is None or key_generator is generate_key:
+        return generate_keys(count)
+    return [key_generator(user) for _ in range(count)]
+
+
 class BaseTokenGenerator():
     def generate_token(self, instance, invitation_url):
         raise NotImplementedError("Create a subclass and implement method")
@@ -81,59 +303,16 @@ class BaseTokenGenerator():
 
 
 class DefaultTokenGenerator(BaseTokenGenerator):
+    """
+    Renders a personalized token image the first time ``token_view`` is hit
+    for a key.  Rendered tokens are saved to ``default_storage`` under
+    ``tokens/`` and kept in ``invitation.tokens.token_cache``.
+    """
+    token_path = 'tokens/%s.png'
+
     def generate_token(self, instance, invitation_url):
-        # token imports
-        from PIL import Image, ImageFont, ImageDraw
-        from django.core.files.temp import NamedTemporaryFile
-        from django.core.files import File
-        import urllib2
-        from urlparse import urlparse, urlunparse
-
-        _, root_url = get_site()
-
-        def stamp(image, text, offset):
-                f = ImageFont.load_default()
-                txt_img = Image.new('RGBA', f.getsize(text))
-                d = ImageDraw.Draw(txt_img)
-                d.text((0, 0), text, font=f, fill="#888")
-                exp_img_r = txt_img.rotate(0, expand=1)
-                iw, ih = image.size
-                tw, th = txt_img.size
-                x = iw / 2 - tw / 2
-                y = ih / 2 - th / 2
-                image.paste(exp_img_r, (x, y + offset), exp_img_r)
-                return offset + th
-
-        # normalize sataic url
-        r_parse = urlparse(root_url, 'http')
-        s_parse = urlparse(settings.STATIC_URL, 'http')
-        s_parts = (s_parse.scheme, s_parse.netloc or r_parse.netloc,
-                   s_parse.path, s_parse.params, s_parse.query,
-                   s_parse.fragment)
-        static_url = urlunparse(s_parts)
-
-        # open base token image
-        img_url = static_url + 'notification/img/token-invite.png'
-        temp_img = NamedTemporaryFile()
-        temp_img.write(urllib2.urlopen(img_url).read())
-        temp_img.flush()
-        image = Image.open(temp_img.name)
-
-        # stamp expiration date
-        delta = datetime.timedelta(days=settings.ACCOUNT_INVITATION_DAYS)
-        expiration_date = instance.date_invited + delta
-        exp_text = expiration_date.strftime("%x")
-        stamp(image, exp_text, 18)
-
-        # stamp recipient name
-        if instance.recipient[1]:
-            offset = stamp(image, instance.recipient[1], -16)
-        if instance.recipient[2]:
-            offset = stamp(image, instance.recipient[2], offset)
-        image.save(temp_img.name, "PNG", quality=95)
-        if not default_storage.exists('tokens/%s.png' % instance.key):
-            default_storage.save('tokens/%s.png' % instance.key,
-                                 File(temp_img))
+        # the token is served from the same site as the invitation link
+        root_url = '%s://%s' % urlsplit(invitation_url)[:2]
         get_token_url = root_url + reverse('invitation_token',
                                            kwargs={'key': instance.key})
         token_html = ''.join(['<a style="display: inline-block;" href="',
@@ -144,62 +323,113 @@ class DefaultTokenGenerator(BaseTokenGenerator):
                               '" alt="invitation token"></a>'])
         return token_html
 
+    def get_token_text(self, instance):
+        """
+        Return the expiration date and the names stamped on the token.
+        """
+        delta = datetime.timedelta(days=settings.ACCOUNT_INVITATION_DAYS)
+        expiration_date = instance.date_invited + delta
+        return (expiration_date.strftime("%x"),
+                (instance.recipient_first_name, instance.recipient_last_name))
+
+    def render_token(self, instance):
+        from invitation import tokens
+
+        return tokens.render_token(*self.get_token_text(instance))
+
+    def render_tokens(self, instances, max_workers=None):
+        """
+        Render the tokens of ``instances`` that aren't in the storage yet
+        across a process pool and save them, ahead of sending a campaign.
+        Returns the number of tokens rendered.
+        """
+        from django.core.files.base import ContentFile
+        from invitation import tokens
+
+        instances = [instance for instance in instances
+                     if not default_storage.exists(
+                         self.token_path % instance.key)]
+        pngs = tokens.render_tokens(
+            [self.get_token_text(instance) for instance in instances],
+            max_workers)
+        for instance, png in zip(instances, pngs):
+            default_storage.save(self.token_path % instance.key,
+                                 ContentFile(png))
+        return len(instances)
+
+    def get_token_image(self, instance, cache_key=None, save=True):
+        """
+        Return the ``(png, etag)`` of the token of ``instance``, from the
+        cache, the storage, or rendered now.
+        """
+        from django.core.files.base import ContentFile
+        from invitation import tokens
+
+        cache_key = cache_key or instance.key
+        entry = tokens.token_cache.get(cache_key)
+        if entry is None:
+            token_path = self.token_path % instance.key
+            if save and default_storage.exists(token_path):
+                with default_storage.open(token_path) as f:
+                    png = f.read()
+            else:
+                png = self.render_token(instance)
+                if save:
+                    default_storage.save(token_path, ContentFile(png))
+            entry = tokens.token_cache.set(cache_key, png)
+        return entry
+
     def token_view(self, request, key):
         '''
-        Returns an aproproate token image.  If the key is valid & token image
-        exist, a personalized token is returned or else a token image marked
-        invalid is returned.
+        Returns an aproproate token image.  If the key is valid, a
+        personalized token is returned or else a token image marked invalid
+        is returned.
+
+        Conditional requests (``If-None-Match``/``If-Modified-Since``) are
+        answered with 304.
         '''
-        import urllib2
-        import mimetypes
         from django.http import HttpResponse
-        from urlparse import urlparse, urlunparse
+        from django.utils.cache import get_conditional_response
+        from django.utils.http import http_date
+        from django.utils.timezone import now
+        from invitation import tokens
         from invitation.models import InvitationKey
 
-        print ('---token')
-        site = get_site(request)
-        scheme = 'http'
-        if request.is_secure():
-            scheme = 'https'
-        root_url = '%s://%s' % (scheme, site.domain)
-        r_parse = urlparse(root_url, scheme)
-        s_parse = urlparse(settings.STATIC_URL, scheme)
-        m_parse = urlparse(settings.MEDIA_URL, scheme)
-        s_parts = (s_parse.scheme, s_parse.netloc or r_parse.netloc,
-                   s_parse.path, s_parse.params, s_parse.query,
-                   s_parse.fragment)
-        static_url = urlunparse(s_parts)
-        m_parts = (m_parse.scheme, m_parse.netloc or r_parse.netloc,
-                   m_parse.path, m_parse.params, m_parse.query,
-                   m_parse.fragment)
-        media_url = urlunparse(m_parts)
-        print ('static_url', static_url)
-        print ('media_url', media_url)
-
-        token_url = '%stokens/%s.png' % (media_url, key)
-        print (token_url)
-        token_invalid_url = '%snotification/img/%s.png' % (static_url,
-                                                           'token-invalid')
-        token_path = 'tokens/%s.png' % key
-        is_key_valid = InvitationKey.objects.is_key_valid
-        valid_key = is_key_valid(key) or key == 'previewkey00000000'
-        if default_storage.exists(token_path) and valid_key:
-            contents = urllib2.urlopen(token_url).read()
-            mimetype = mimetypes.guess_type(token_url)
-            response = HttpResponse(contents, mimetype=mimetype)
+        last_modified = None
+        instance = InvitationKey.objects.is_key_valid(key)
+        if instance:
+            png, etag = self.get_token_image(instance)
+            last_modified = int(calendar.timegm(
+                instance.date_invited.utctimetuple()))
+        elif key == 'previewkey00000000':
+            instance = InvitationKey(key=key, date_invited=now())
+            cache_key = '%s:%s' % (key, instance.date_invited.date())
+            png, etag = self.get_token_image(instance, cache_key, save=False)
         else:
-            contents = urllib2.urlopen(token_invalid_url).read()
-            mimetype = mimetypes.guess_type(token_invalid_url)
-            response = HttpResponse(contents, mimetype=mimetype)
-
+            png = tokens.read_static_file(tokens.TOKEN_INVALID_IMAGE)
+            etag = tokens.static_file_etag(tokens.TOKEN_INVALID_IMAGE)
+
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=last_modified)
+        if response is None:
+            response = HttpResponse(png, content_type='image/png')
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
         return response
 
-    def handle_invitation_delete(self, instance):
-        """Delete token image."""
+    def forget_token(self, instance):
+        from invitation import tokens
+
+        tokens.token_cache.evict(instance.key)
         try:
-            default_storage.delete('tokens/%s.png' % instance.key)
-        except:
+            default_storage.delete(self.token_path % instance.key)
+        except Exception:
             pass
 
+    def handle_invitation_delete(self, instance):
+        """Delete token image."""
+        self.forget_token(instance)
+
     def handle_invitation_used(self, instance):
-        default_storage.delete('tokens/%s.png' % instance.key)
+        self.forget_token(instance)
@@ -5,26 +5,21 @@ from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
 from django.http import HttpResponseRedirect
-from django.shortcuts import render, render_to_response
-from django.template import RequestContext
-from django.template.loader import render_to_string
+from django.shortcuts import render
+from django.core.cache import caches
 from django.utils.safestring import mark_safe
-from django.utils.translation import ugettext_lazy as _
+from django.utils.timezone import now
+from django.utils.translation import get_language, ugettext_lazy as _
 
-from invitation import utils, models
+from invitation import models, tickets, utils
+from invitation.backends import get_cached_template
 from invitation.models import InvitationKey
 
+from hashlib import sha1 as sha_constructor
 import logging
+import os
 logger = logging.getLogger(__name__)
 
-reg_backend_class = utils.get_registration_backend_class()
-reg_backend = reg_backend_class()
-RegistrationForm = reg_backend.get_registration_form()
-registration_template = reg_backend.get_registration_template()
-registration_register = reg_backend.get_registration_view()
-
-InvitationKeyForm = utils.get_invitation_form()
-
 is_key_valid = InvitationKey.objects.is_key_valid
 get_key = InvitationKey.objects.get_key
 objs = InvitationKey.objects
@@ -63,20 +58,70 @@ def invited(request, invitation_key=None, invitation_recipient=None,
                 invitation_recipient
             extra_context\
                 .update({'invitation_recipient': invitation_recipient})
-            request.session['invitation_key'] = valid_key_obj.key
-            request.session['invitation_recipient'] = invitation_recipient
-            request.session['invitation_context'] = extra_context or {}
+            tickets.issue_ticket(request, valid_key_obj, invitation_recipient)
 
         return render(request, template_name, extra_context)
     else:
         return HttpResponseRedirect(reverse('registration_register'))
 
 
-def register(request, backend, success_url=None,
-             form_class=RegistrationForm,
+def invited_signed(request, ticket, extra_context=None):
+    """
+    Accept a signed invitation link (``INVITATION_SIGNED_LINKS``).  Forged
+    and expired links are rejected from the signature alone, the key is
+    only checked again when the signup is submitted.
+    """
+    if not getattr(settings, 'INVITE_MODE', False):
+        return HttpResponseRedirect(reverse('registration_register'))
+    extra_context = extra_context is not None and extra_context.copy() or {}
+    invitation = tickets.load_ticket(ticket)
+    if invitation is None:
+        extra_context.update({'invalid_key': True})
+        template_name = 'invitation/wrong_invitation_key.html'
+    elif not invitation.is_valid():
+        extra_context.update(invitation.get_context())
+        template_name = 'invitation/wrong_invitation_key.html'
+    else:
+        extra_context.update({'invitation_key': invitation.key,
+                              'invitation_recipient': invitation.recipient})
+        tickets.set_ticket(request, ticket)
+        template_name = 'invitation/invited.html'
+    return render(request, template_name, extra_context)
+
+
+def __getattr__(name):
+    # the registration backend and the forms are resolved on first use, these
+    # module attributes are kept for backwards compatibility
+    if name == 'InvitationKeyForm':
+        return utils.get_invitation_form()
+    if name not in ('reg_backend', 'RegistrationForm',
+                    'registration_template'):
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+    reg_backend = utils.get_registration_backend()
+    if name == 'RegistrationForm':
+        return reg_backend.get_registration_form()
+    if name == 'registration_template':
+        return reg_backend.get_registration_template()
+    return reg_backend
+
+
+def registration_register(request, backend, success_url, form_class,
+                          disallowed_url, template_name, extra_context):
+    reg_backend = utils.get_registration_backend()
+    register_view = reg_backend.get_registration_view()
+    return register_view(
+        request, backend or reg_backend.get_backend(), success_url,
+        form_class or reg_backend.get_registration_form(), disallowed_url,
+        template_name or reg_backend.get_registration_template(),
+        extra_context)
+
+
+def register(request, backend=None, success_url=None,
+             form_class=None,
              disallowed_url='registration_disallowed',
              post_registration_redirect=None,
-             template_name=registration_template,
+             template_name=None,
              wrong_template_name='invitation/wrong_invitation_key.html',
              extra_context=None):
     extra_context = extra_context is not None and extra_context.copy() or {}
@@ -99,11 +144,46 @@ def register(request, backend, success_url=None,
                                      extra_context)
 
 
+def template_mtime(template):
+    try:
+        return os.path.getmtime(template.origin.name)
+    except (AttributeError, TypeError, OSError):
+        return None
+
+
+def render_previews(user, template_names):
+    """
+    Render the email templates ``template_names`` for a sample invitation from
+    ``user`` and return the results.
+
+    Previews are cached for ``INVITATION_PREVIEW_CACHE_TIMEOUT`` seconds,
+    keyed by the modification time of the templates and the active language,
+    so that editing a template or switching languages shows a fresh preview.
+    """
+    templates = [get_cached_template(name) for name in template_names]
+    timeout = getattr(settings, 'INVITATION_PREVIEW_CACHE_TIMEOUT', 3600)
+    cache = caches[getattr(settings, 'INVITATION_KEY_CACHE_ALIAS', 'default')]
+    key_data = (template_names, [template_mtime(t) for t in templates],
+                get_language(), user.pk, now().date())
+    cache_key = 'invitation:preview:' + \
+        sha_constructor(repr(key_data).encode()).hexdigest()
+    previews = cache.get(cache_key) if timeout else None
+    if previews is None:
+        invitation = InvitationKey.objects.create_invitation(user, save=False)
+        note = _('--your note will be inserted here--')
+        preview_context = invitation.get_context({'sender_note': note})
+        previews = [template.render(preview_context) for template in templates]
+        if timeout:
+            cache.set(cache_key, previews, timeout)
+    return previews
+
+
 @login_required
 def invite(request, success_url=None,
-           form_class=InvitationKeyForm,
+           form_class=None,
            template_name='invitation/invitation_form.html',
            extra_context=None):
+    form_class = form_class or utils.get_invitation_form()
     extra_context = extra_context is not None and extra_context.copy() or {}
     remaining_invitations = remaining_invitations_for_user(request.user)
     if request.method == 'POST':
@@ -125,52 +205,90 @@ def invite(request, success_url=None,
                 # TODO: make this changeable per request
                 delivery_backend_class = utils.get_delivery_backend_class()
                 delivery_backend = delivery_backend_class(form.cleaned_data)
-                invite = delivery_backend.create_invitation(request.user)
-                invite.send_to(delivery_backend)
-
-                # success_url needs to be dynamically generated here; setting a
-                # a default value using reverse() will cause circular-import
-                # problems with the default URLConf for this application, which
-                # imports this file.
-                success_url = success_url or reverse('invitation_complete')
-                return HttpResponseRedirect(success_url)
+                # the quota is enforced again by the database, the form only
+                # saw the count from before this request
+                invite = delivery_backend.create_invitation(request.user,
+                                                            reserve=True)
+                if invite is None:
+                    form.add_error(None, _("Sorry, you don't have any "
+                                           "invitations left"))
+                    remaining_invitations = 0
+                else:
+                    try:
+                        invite.send_to(delivery_backend, request)
+                    except Exception:
+                        logger.exception("Sending invitation %s failed",
+                                         invite.pk)
+                        # deleting the key releases the reservation
+                        invite.delete()
+                        form.add_error(None, _("Sorry, the invitation "
+                                               "couldn't be sent"))
+                        remaining_invitations = \
+                            remaining_invitations_for_user(request.user)
+                    else:
+                        # success_url needs to be dynamically generated here;
+                        # setting a a default value using reverse() will cause
+                        # circular-import problems with the default URLConf
+                        # for this application, which imports this file.
+                        success_url = success_url or \
+                            reverse('invitation_complete')
+                        return HttpResponseRedirect(success_url)
     else:
         form = form_class()
-    objs = InvitationKey.objects
-    invitation = objs.create_invitation(request.user, save=False)
-    note = _('--your note will be inserted here--')
-    preview_context = invitation.get_context({'sender_note': note})
+    email_preview, = render_previews(request.user,
+                                     ('invitation/invitation_email.html',))
     extra_context.update({
         'form': form,
         'remaining_invitations': remaining_invitations,
-        'email_preview': render_to_string('invitation/invitation_email.html',
-                                          preview_context),
+        'email_preview': email_preview,
     })
     return render(request, template_name, extra_context)
 
 
+def parse_bulk_recipients(to_emails):
+    """
+    Parse "email; email, firstname, lastname; ..." into a list of recipient
+    dicts, skipping empty and duplicate email addresses.
+    """
+    recipients = []
+    seen = set()
+    for entry in to_emails.split(';'):
+        parts = [part.strip() for part in entry.split(',')]
+        email = parts[0]
+        if not email or email.lower() in seen:
+            continue
+        seen.add(email.lower())
+        parts += [''] * (3 - len(parts))
+        recipients.append({models.KEY_EMAIL: email,
+                           models.KEY_FNAME: parts[1],
+                           models.KEY_LNAME: parts[2]})
+    return recipients
+
+
 @staff_member_required
 def send_bulk_invitations(request, success_url=None):
     # current_site, root_url = utils.get_site(request)
     if request.POST.get('post'):
-        to_emails = [(e.split(',')[0].strip(), e.split(',')[1].strip() or None,
-                      e.split(',')[2].strip() or None) if e.find(',') + 1 else
-                     (e.strip() or None, None, None)
-                     for e in request.POST['to_emails'].split(';')]
+        recipients = parse_bulk_recipients(request.POST['to_emails'])
 
         sender_note = request.POST['sender_note']
         from_email = request.POST['from_email']
-        if len(to_emails) > 0 and to_emails[0] != '':
-            for recipient in to_emails:
-                if recipient[0]:
-                    objs = InvitationKey.objects
-                    invitation = objs.create_invitation(request.user,
-                                                        {models.KEY_EMAIL: recipient})
-                    try:
-                        invitation.send_to(from_email, mark_safe(sender_note))
-                    except:
-                        messages.error(request, "Mail to %s failed" %
-                                       recipient[0])
+        if recipients:
+            delivery_backend_class = utils.get_delivery_backend_class()
+            delivery_backend = delivery_backend_class({
+                'sender_note': mark_safe(sender_note),
+                'from_email': from_email,
+            })
+            batch_size = getattr(settings, 'INVITATION_BULK_BATCH_SIZE', 500)
+            for start in range(0, len(recipients), batch_size):
+                batch = recipients[start:start + batch_size]
+                invitations = delivery_backend.create_invitations(request.user,
+                                                                  batch)
+                failed = delivery_backend.send_invitations(invitations,
+                                                           request)
+                for invitation, error in failed:
+                    messages.error(request, "Mail to %s failed" %
+                                   invitation.recipient_email)
             messages.success(request, _("Mail sent successfully"))
             success_url = success_url or reverse('invitation_invite_bulk')
             return HttpResponseRedirect(success_url)
@@ -179,26 +297,19 @@ def send_bulk_invitations(request, success_url=None):
             messages.error(request, err)
             return HttpResponseRedirect(reverse('invitation_invite_bulk'))
     else:
-        invitation = InvitationKey.objects.create_invitation(request.user,
-                                                             save=False)
-        note = _('--your note will be inserted here--')
-        preview_context = invitation.get_context({'sender_note': note})
-
-        html_template = 'invitation/invitation_email.html'
-        text_template = 'invitation/invitation_email.txt'
+        html_preview, text_preview = render_previews(
+            request.user, ('invitation/invitation_email.html',
+                           'invitation/invitation_email.txt'))
         context = {
             'title': "Send Bulk Invitations",
-            'html_preview': render_to_string(html_template, preview_context),
-            'text_preview': render_to_string(text_template, preview_context),
+            'html_preview': html_preview,
+            'text_preview': text_preview,
         }
-        return render_to_response('invitation/invitation_form_bulk.html',
-                                  context,
-                                  context_instance=RequestContext(request))
+        return render(request, 'invitation/invitation_form_bulk.html',
+                      context)
 
 
 def token(request, key):
     # This view should only be called if INVITATION_USE_TOKEN is True so we
     # assume that here
-    generator_class = utils.get_token_generator_class()
-    generator = generator_class()
-    return generator.token_view(request, key)
+    return utils.get_token_generator().token_view(request, key)